@@ -0,0 +1,23 @@
+revision = '2f4a8c91d3e'
+down_revision = '40132825652'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('search_document',
+        sa.Column('id', postgresql.UUID(), nullable=False),
+        sa.Column('parent', sa.Text(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER TABLE search_document ADD COLUMN vector TSVECTOR')
+    op.create_index('ix_search_document_parent', 'search_document',
+                    ['parent'])
+    op.execute('CREATE INDEX ix_search_document_vector '
+               'ON search_document USING gin (vector)')
+
+
+def downgrade():
+    op.drop_table('search_document')
@@ -0,0 +1,14 @@
+revision = '3b7d2e5a1c4'
+down_revision = '2f4a8c91d3e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('steno_chapter',
+        sa.Column('content_hash', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('steno_chapter', 'content_hash')
@@ -0,0 +1,34 @@
+revision = '4c1e8f2b7a9'
+down_revision = '3b7d2e5a1c4'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('mandate_stats',
+        sa.Column('id', postgresql.UUID(), nullable=False),
+        sa.Column('question_count', sa.Integer(), nullable=False),
+        sa.Column('interpelation_count', sa.Integer(), nullable=False),
+        sa.Column('paragraph_count', sa.Integer(), nullable=False),
+        sa.Column('sponsorship_count', sa.Integer(), nullable=False),
+        sa.Column('local_question_count', sa.Integer(), nullable=False),
+        sa.Column('local_score', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['id'], ['mandate.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_mandate_stats_question_count', 'mandate_stats',
+                    ['question_count'])
+    op.create_index('ix_question_mandate_id', 'question', ['mandate_id'])
+    op.create_index('ix_steno_paragraph_mandate_id', 'steno_paragraph',
+                    ['mandate_id'])
+    op.create_index('ix_sponsorship_mandate_id', 'sponsorship',
+                    ['mandate_id'])
+
+
+def downgrade():
+    op.drop_index('ix_sponsorship_mandate_id')
+    op.drop_index('ix_steno_paragraph_mandate_id')
+    op.drop_index('ix_question_mandate_id')
+    op.drop_table('mandate_stats')
@@ -0,0 +1,12 @@
+revision = '5a9d3f6c2e8'
+down_revision = '4c1e8f2b7a9'
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_match_score', 'match', ['score'])
+
+
+def downgrade():
+    op.drop_index('ix_match_score')
@@ -1,5 +1,9 @@
+import os
 import pytest
 from mock import Mock
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.compiler import compiles
 
 
 class MockSession:
@@ -16,3 +20,65 @@ class MockSession:
 @pytest.fixture
 def session():
     return MockSession()
+
+
+@compiles(UUID, 'sqlite')
+def compile_uuid_for_sqlite(type_, compiler, **kw):
+    return 'TEXT'
+
+
+def sqlite_to_tsvector(config, text):
+    return text
+
+
+@pytest.fixture
+def sqlite_app(request):
+    """ The app on an in-memory SQLite database; the models work there,
+    except for full-text queries """
+    from mptracker.app import create_app
+    from mptracker import models
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SECRET_KEY'] = 'test'
+    ctx = app.app_context()
+    ctx.push()
+
+    @event.listens_for(models.db.engine, 'connect')
+    def register_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function('to_tsvector', 2,
+                                         sqlite_to_tsvector)
+
+    models.db.create_all()
+
+    def teardown():
+        models.db.session.remove()
+        models.db.drop_all()
+        ctx.pop()
+
+    request.addfinalizer(teardown)
+    return app
+
+
+@pytest.fixture
+def pg_app(request):
+    """ The app on the PostgreSQL database in `MPTRACKER_TEST_DATABASE`;
+    tests that use it are skipped if it's not set """
+    database = os.environ.get('MPTRACKER_TEST_DATABASE')
+    if not database:
+        pytest.skip("MPTRACKER_TEST_DATABASE is not set")
+    from mptracker.app import create_app
+    from mptracker import models
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    app.config['SECRET_KEY'] = 'test'
+    ctx = app.app_context()
+    ctx.push()
+    models.db.create_all()
+
+    def teardown():
+        models.db.session.remove()
+        models.db.drop_all()
+        ctx.pop()
+
+    request.addfinalizer(teardown)
+    return app
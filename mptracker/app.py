@@ -1,5 +1,8 @@
 import os
 import logging
+import hashlib
+from datetime import timedelta
+from collections import defaultdict, OrderedDict
 import flask
 from flask.ext.script import Manager
 from path import path
@@ -12,6 +15,7 @@ from mptracker.admin import admin
 from mptracker.placenames import placenames_manager
 from mptracker.scraper import scraper_manager
 from mptracker.proposals import proposals, proposals_manager
+from mptracker.search import search, search_manager, index_documents
 
 
 logger = logging.getLogger(__name__)
@@ -42,6 +46,7 @@ def create_app():
     app.register_blueprint(pages)
     app.register_blueprint(questions)
     app.register_blueprint(proposals)
+    app.register_blueprint(search)
     admin.init_app(app)
     app._logger = logger
     if app.debug:
@@ -57,6 +62,7 @@ manager.add_command('questions', questions_manager)
 manager.add_command('placenames', placenames_manager)
 manager.add_command('scraper', scraper_manager)
 manager.add_command('proposals', proposals_manager)
+manager.add_command('search', search_manager)
 
 
 @manager.command
@@ -93,49 +99,162 @@ def import_people():
     session.commit()
 
 
-def import_steno_day(day):
-    from mptracker.scraper.common import get_cached_session
-    from mptracker.scraper.steno import StenogramScraper
-    http_session = get_cached_session()
+def steno_chapter_hash(steno_chapter):
+    content = [steno_chapter.headline] + [
+        (p['serial'], p['speaker_cdep_id'], p['speaker_name'], p['text'])
+        for p in steno_chapter.paragraphs]
+    return hashlib.md5(repr(content).encode('utf-8')).hexdigest()
+
+
+def steno_paragraph_rows(steno_chapter, chapter_id, day, speaker_index):
+    for paragraph in steno_chapter.paragraphs:
+        yield {
+            'id': models.random_uuid(),
+            'chapter_id': chapter_id,
+            'text': paragraph['text'],
+            'serial': paragraph['serial'],
+            'mandate_id': speaker_index.find(paragraph['speaker_cdep_id'],
+                                             paragraph['speaker_name'],
+                                             day),
+        }
 
-    person_matcher = models.PersonMatcher()
+
+def save_steno_day(steno_day, existing, speaker_index):
+    """ Insert new chapters, and replace the paragraphs of chapters whose
+    content changed; `existing` maps serials of chapters already in the
+    database to their `(id, content_hash)`. Returns counters. """
     session = models.db.session
-    steno_scraper = StenogramScraper(http_session)
-    steno_day = steno_scraper.fetch_day(day)
-    new_paragraphs = 0
+    Chapter = models.StenoChapter.__table__
+    Paragraph = models.StenoParagraph.__table__
+    Document = models.SearchDocument.__table__
+
+    new_chapters = []
+    changed_chapters = []
+    paragraph_rows = []
     for steno_chapter in steno_day.chapters:
-        chapter_ob = models.StenoChapter(date=steno_day.date,
-                                         headline=steno_chapter.headline,
-                                         serial=steno_chapter.serial)
-        session.add(chapter_ob)
-        for paragraph in steno_chapter.paragraphs:
-            person = person_matcher.get_person(paragraph['speaker_name'],
-                                               paragraph['speaker_cdep_id'])
-
-            paragraph_ob = models.StenoParagraph(text=paragraph['text'],
-                                                 chapter=chapter_ob,
-                                                 person=person,
-                                                 serial=paragraph['serial'])
-            session.add(paragraph_ob)
-            new_paragraphs += 1
-    print('added', new_paragraphs, 'stenogram paragraphs')
+        chapter_hash = steno_chapter_hash(steno_chapter)
+        (chapter_id, old_hash) = existing.get(steno_chapter.serial,
+                                              (None, None))
+        if chapter_id is None:
+            chapter_id = models.random_uuid()
+            new_chapters.append({
+                'id': chapter_id,
+                'date': steno_day.date,
+                'headline': steno_chapter.headline,
+                'serial': steno_chapter.serial,
+                'content_hash': chapter_hash,
+            })
+        elif chapter_hash != old_hash:
+            changed_chapters.append({
+                'chapter_id': chapter_id,
+                'headline': steno_chapter.headline,
+                'content_hash': chapter_hash,
+            })
+        else:
+            continue
+        paragraph_rows.extend(steno_paragraph_rows(
+            steno_chapter, chapter_id, steno_day.date, speaker_index))
+
+    mandate_ids = set(row['mandate_id'] for row in paragraph_rows)
+    if changed_chapters:
+        changed_ids = [row['chapter_id'] for row in changed_chapters]
+        mandate_ids.update(mandate_id for (mandate_id,) in session.execute(
+            models.db.select([Paragraph.c.mandate_id])
+                     .where(Paragraph.c.chapter_id.in_(changed_ids))
+                     .distinct()))
+        old_paragraphs = (models.db.select([Paragraph.c.id])
+                                   .where(Paragraph.c.chapter_id
+                                                  .in_(changed_ids)))
+        session.execute(Document.delete()
+                                .where(Document.c.id.in_(old_paragraphs)))
+        session.execute(Paragraph.delete()
+                                 .where(Paragraph.c.chapter_id
+                                                 .in_(changed_ids)))
+        session.execute(
+            Chapter.update()
+                   .where(Chapter.c.id == models.db.bindparam('chapter_id'))
+                   .values(headline=models.db.bindparam('headline'),
+                           content_hash=models.db.bindparam('content_hash')),
+            changed_chapters)
+    if new_chapters:
+        session.execute(Chapter.insert(), new_chapters)
+    if paragraph_rows:
+        session.execute(Paragraph.insert(), paragraph_rows)
+        index_documents(session, [(row['id'], 'steno_paragraph', row['text'])
+                                  for row in paragraph_rows])
+    models.refresh_mandate_stats(mandate_ids)
     session.commit()
+    return {
+        'new': len(new_chapters),
+        'changed': len(changed_chapters),
+        'paragraphs': len(paragraph_rows),
+    }
 
 
 @manager.command
-def import_steno(day=None, stdin=False):
+def import_steno(day=None, stdin=False, start=None, end=None,
+                 workers='4', refresh=False):
+    """ Import stenograms. Only chapters missing from the database are
+    fetched, so re-running over days already imported costs one request
+    per day; with `--refresh`, existing chapters are fetched too, and
+    updated if their content changed. Each day is saved in its own
+    transaction, so an interrupted import can simply be restarted. """
+    from mptracker.scraper.common import create_session
+    from mptracker.scraper.steno import StenogramScraper
+
     if stdin:
         import sys
-        days = [line.strip() for line in sys.stdin]
+        days = [parse_date(line.strip()) for line in sys.stdin
+                if line.strip()]
+    elif start is not None and end is not None:
+        start_date, end_date = parse_date(start), parse_date(end)
+        days = [start_date + timedelta(days=n)
+                for n in range((end_date - start_date).days + 1)]
     elif day is not None:
-        days = [day]
+        days = [parse_date(day)]
     else:
-        raise RuntimeError("Need day or stdin")
-
-    for day in days:
-        try:
-            import_steno_day(parse_date(day))
-            print(day, "ok")
-        except Exception as e:
-            models.db.session.rollback()
-            print(day, "fail", e)
+        raise RuntimeError("Need day, start and end, or stdin")
+
+    days = list(OrderedDict.fromkeys(days))  # each day is imported once
+    if not days:
+        return
+
+    session = models.db.session
+    Chapter = models.StenoChapter
+    existing = defaultdict(dict)
+    query = (session.query(Chapter.date, Chapter.serial,
+                           Chapter.id, Chapter.content_hash)
+                    .filter(Chapter.date >= min(days))
+                    .filter(Chapter.date <= max(days)))
+    for (date, serial, id, content_hash) in query:
+        existing[date][serial] = (id, content_hash)
+
+    speaker_index = models.SpeakerIndex()
+    steno_scraper = StenogramScraper(
+        create_session(cache_name='page-cache', throttle=0.5),
+        workers=int(workers))
+
+    def skip_serials_for_day(day):
+        return () if refresh else set(existing[day])
+
+    # days and their chapters are fetched concurrently; saving happens
+    # here, in order, one transaction per day
+    for day, steno_day, error in steno_scraper.fetch_days(
+            days, skip_serials_for_day):
+        if error is None:
+            try:
+                counters = save_steno_day(steno_day, existing[day],
+                                          speaker_index)
+            except Exception as e:
+                session.rollback()
+                error = e
+        if error is None:
+            print(day, "ok", "{new} new chapters, {changed} changed, "
+                             "{paragraphs} paragraphs".format(**counters))
+        else:
+            print(day, "fail", error)
+
+    if speaker_index.unresolved:
+        print("unresolved speakers:")
+        for name, count in speaker_index.unresolved.most_common():
+            print('  %5d %s' % (count, name))
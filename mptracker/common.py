@@ -1,14 +1,21 @@
 from datetime import datetime
 from contextlib import contextmanager
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+import os
+import time
 import subprocess
+import hashlib
 import logging
 import tempfile
 import csv
 import re
+import base64
 from io import StringIO
 from itertools import chain
 import flask
+from sqlalchemy import and_, or_
+from sqlalchemy.orm.interfaces import MANYTOONE
 from werkzeug.routing import BaseConverter, ValidationError
 from flask.ext.rq import job
 from path import path
@@ -17,6 +24,11 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 MAX_OCR_PAGES = 3
+OCR_LANGUAGE = 'ron'
+MIN_TEXT_LAYER_CHARS = 20
+PDFTOTEXT_TIMEOUT = 10
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
 common = flask.Blueprint('common', __name__)
 
@@ -58,21 +70,171 @@ class RowNotFound(Exception):
     """ Could not find row to match key. """
 
 
-AddResult = namedtuple('AddResult', ['row', 'is_new', 'is_changed'])
+class NullKey(Exception):
+    """ Record has no value for a key column. """
+
+
+class DuplicateKey(Exception):
+    """ Several records have the same key. """
+
+
+class AddResult:
+
+    def __init__(self, patcher, key, row, is_new, is_changed):
+        self.patcher = patcher
+        self.key = key
+        self._row = row
+        self.is_new = is_new
+        self._is_changed = is_changed
+
+    @property
+    def is_changed(self):
+        """ For a queued record, known once its row has been compared """
+        if self._is_changed is None:
+            self.patcher.apply_pending()
+        return self._is_changed
+
+    @property
+    def row(self):
+        if self._row is None:
+            self._row = self.patcher.get_row(self.key)
+        return self._row
+
+    @property
+    def id(self):
+        """ Primary key of the row, without loading it if it's unchanged """
+        row_id = self.patcher.existing.get(self.key)
+        if row_id is None:
+            row_id = self.row.id
+        return row_id
+
+
+def new_counters():
+    return {'n_add': 0, 'n_update': 0, 'n_remove': 0, 'n_ok': 0, 'total': 0}
+
+
+def content_hash(values):
+    return hashlib.md5(repr(tuple(values)).encode('utf-8')).digest()
 
 
 class TablePatcher:
+    """ Keeps an index of existing rows that holds just their keys, ids and
+    a hash of the patched columns; full rows are loaded only when they need
+    to change, in batches of `batch_size`. """
+
+    batch_size = 500
 
     def __init__(self, model, session, key_columns):
         self.model = model
         self.session = session
         self.key_columns = key_columns
-        self.existing = {}
-        for row in self.model.query:
-            key = self.row_key(row)
-            assert key not in self.existing, "Duplicate key %r" % key
-            self.existing[key] = row
+        self.table_columns = set(c.name for c in model.__table__.columns)
+        self.relationships = model.__mapper__.relationships
+        self.existing = None
+        self.hashes = {}
+        self.rows = {}
+        self.pending = {}
         self.seen = set()
+        self.counters = new_counters()
+
+    def field_columns(self, name):
+        """ Table columns that hold record field `name`; a many-to-one
+        relationship is held by its foreign key columns. """
+        if name in self.table_columns:
+            return [self.model.__table__.c[name]]
+        if name in self.relationships:
+            prop = self.relationships[name]
+            if prop.direction is MANYTOONE:
+                return [local for (local, remote) in prop.local_remote_pairs]
+        return None
+
+    def field_values(self, name, value):
+        if name in self.table_columns:
+            return [value]
+        prop = self.relationships[name]
+        return [None if value is None else
+                getattr(value, prop.mapper.get_property_by_column(remote).key)
+                for (local, remote) in prop.local_remote_pairs]
+
+    def record_hash_fields(self, record):
+        fields = tuple(sorted(k for k in record if k not in self.key_columns))
+        for name in fields:
+            if self.field_columns(name) is None:
+                return None  # e.g. a python property; can't be indexed
+        return fields
+
+    def record_hash(self, record, fields):
+        return content_hash(value for name in fields
+                            for value in self.field_values(name, record[name]))
+
+    def load_index(self, fields):
+        n_key = len(self.key_columns)
+        columns = ([getattr(self.model, k) for k in self.key_columns] +
+                   [self.model.__mapper__.primary_key[0]] +
+                   [c for name in fields for c in self.field_columns(name)])
+        load_ids = self.existing is None
+        if load_ids:
+            self.existing = {}
+        hashes = self.hashes[fields] = {}
+        for values in self.session.query(*columns).yield_per(1000):
+            key = tuple(values[:n_key])
+            if load_ids:
+                assert key not in self.existing, "Duplicate key %r" % key
+                self.existing[key] = values[n_key]
+            hashes[key] = content_hash(values[n_key + 1:])
+
+    def key_filter(self, keys):
+        if len(self.key_columns) == 1:
+            [column] = self.key_columns
+            return getattr(self.model, column).in_([k[0] for k in keys])
+        return or_(*[and_(*[getattr(self.model, column) == value
+                            for (column, value) in zip(self.key_columns, key)])
+                     for key in keys])
+
+    def load_rows(self, keys):
+        """ Load the rows for `keys` with one query per batch """
+        keys = [key for key in keys if key not in self.rows]
+        for offset in range(0, len(keys), self.batch_size):
+            batch = keys[offset : offset + self.batch_size]
+            for row in self.model.query.filter(self.key_filter(batch)):
+                self.rows[self.row_key(row)] = row
+
+    def apply_pending(self):
+        """ Write the records queued by `add` to their rows, and count them
+        by what actually changed; a different hash can come from values
+        that compare equal, e.g. a `Decimal` and a `float`. """
+        self.load_rows(list(self.pending))
+        for key, (record, result) in self.pending.items():
+            row = self.rows[key]
+            changes = [k for k in record if getattr(row, k) != record[k]]
+            if changes:
+                logger.info("Updating %r %s", key, ','.join(changes))
+            for k in changes:
+                setattr(row, k, record[k])
+            result._is_changed = bool(changes)
+            self.count(result)
+        self.pending.clear()
+
+    def count(self, result):
+        if result.is_new:
+            self.counters['n_add'] += 1
+
+        elif result.is_changed:
+            self.counters['n_update'] += 1
+
+        else:
+            self.counters['n_ok'] += 1
+
+    def get_row(self, key):
+        if key in self.pending:
+            self.apply_pending()
+        row = self.rows.get(key)
+        if row is None:
+            self.load_rows([key])
+            row = self.rows.get(key)
+            if row is None:
+                raise RowNotFound("Could not find row with key=%r" % key)
+        return row
 
     def row_key(self, row):
         return tuple(getattr(row, k) for k in self.key_columns)
@@ -82,76 +244,123 @@ class TablePatcher:
 
     def add(self, record, create=True):
         key = self.dict_key(record)
-        row = self.existing.get(key)
+        if key in self.pending:
+            self.apply_pending()
+        fields = self.record_hash_fields(record)
+        if self.existing is None:
+            self.load_index(fields or ())
+        if fields is not None and fields not in self.hashes:
+            self.load_index(fields)
+        if fields is None:
+            record_hash = None
+        else:
+            record_hash = self.record_hash(record, fields)
+        row = None
         is_new = is_changed = False
 
-        if row is None:
+        if key not in self.existing:
             if create:
                 row = self.model()
                 logger.info("Adding %r", key)
                 is_new = is_changed = True
                 self.session.add(row)
-                self.existing[key] = row
+                self.rows[key] = row
+                self.existing[key] = None
+                for k in record:
+                    setattr(row, k, record[k])
 
             else:
                 raise RowNotFound("Could not find row with key=%r" % key)
 
-        else:
-            changes = []
-            for k in record:
-                old_val = getattr(row, k)
-                new_val = record[k]
-                if old_val != new_val:
-                    logger.debug("Value change for %r: %s %r != %r",
-                                 key, k, old_val, new_val)
-                    changes.append(k)
-
+        elif record_hash is None:
+            # compare field by field, on the loaded row
+            row = self.get_row(key)
+            changes = [k for k in record if getattr(row, k) != record[k]]
             if changes:
                 logger.info("Updating %r %s", key, ','.join(changes))
                 is_changed = True
-
-        if is_changed:
-            for k in record:
+            for k in changes:
                 setattr(row, k, record[k])
 
+        elif record_hash != self.hashes[fields].get(key):
+            # compared with the row, and counted, by `apply_pending`
+            is_changed = None
+
+        result = AddResult(self, key, row, is_new, is_changed)
+
+        if is_changed is not False:
+            # other field sets' hashes for this row are out of date now
+            for other_hashes in self.hashes.values():
+                other_hashes.pop(key, None)
+        if record_hash is not None:
+            self.hashes[fields][key] = record_hash
         self.seen.add(key)
 
-        return AddResult(row, is_new, is_changed)
+        if is_changed is None:
+            self.pending[key] = (record, result)
+            if len(self.pending) >= self.batch_size:
+                self.apply_pending()
+        else:
+            self.count(result)
+
+        return result
 
     @contextmanager
-    def process(self, autoflush=None, remove=False):
-        counters = {'n_add': 0, 'n_update': 0,
-                    'n_remove': 0, 'n_ok': 0, 'total': 0}
+    def process(self, autoflush=None, remove=False, commit_every=None,
+                before_commit=None, dry_run=False):
+        """ Yield an `add` function for records. With `commit_every`, the
+        session is committed, and cached rows dropped, every that many
+        records, so a long run keeps its progress if it's interrupted.
+        `before_commit` is called before each commit, once the records are
+        flushed, to write anything that must be committed along with them.
+        With `dry_run`, changes are only counted and logged; the session is
+        rolled back at the end instead of committed. """
+        counters = self.counters = new_counters()
+
+        def commit():
+            self.apply_pending()
+            if before_commit is not None:
+                self.session.flush()
+                before_commit()
+            self.session.commit()
 
         def add(record, create=True):
             result = self.add(record, create=create)
 
-            counters['total'] += 0
-            if autoflush and counters['total'] % autoflush == 0:
+            counters['total'] += 1
+            if (commit_every and not dry_run
+                    and counters['total'] % commit_every == 0):
+                commit()
+                self.rows.clear()
+                logger.info("Committed %d records", counters['total'])
+            elif autoflush and counters['total'] % autoflush == 0:
+                self.apply_pending()
                 self.session.flush()
 
-            if result.is_new:
-                counters['n_add'] += 1
-
-            elif result.is_changed:
-                counters['n_update'] += 1
-
-            else:
-                counters['n_ok'] += 1
-
             return result
 
         self.seen.clear()
 
         yield add
 
+        self.apply_pending()
         if remove:
-            for key in set(self.existing) - self.seen:
-                self.session.delete(self.existing[key])
+            if self.existing is None:
+                self.load_index(())
+            removed = set(self.existing) - self.seen
+            self.load_rows(list(removed))
+            for key in removed:
+                self.session.delete(self.rows.pop(key))
+                del self.existing[key]
+                for hashes in self.hashes.values():
+                    hashes.pop(key, None)
                 logger.info("Removing %r", key)
                 counters['n_remove'] += 1
 
-        self.session.commit()
+        if dry_run:
+            self.session.rollback()
+        else:
+            commit()
         logger.info("Created %d, updated %d, removed %d, found ok %d.",
                     counters['n_add'], counters['n_update'],
                     counters['n_remove'], counters['n_ok'])
@@ -160,32 +369,303 @@ class TablePatcher:
         with self.process(autoflush=1000, remove=remove) as add:
             for record in data:
                 add(record, create=create)
+        return self.counters
+
+
+def copy_text_value(value):
+    """ Encode a value for PostgreSQL's `COPY ... FROM STDIN` text format """
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\')
+                      .replace('\t', '\\t')
+                      .replace('\n', '\\n')
+                      .replace('\r', '\\r'))
+
+
+class BulkTablePatcher:
+    """ Same job as `TablePatcher`, but the records are staged into a
+    temporary table with `COPY`, and applied with set-based SQL; an empty
+    table is loaded with `COPY` directly. Only works on PostgreSQL. """
+
+    staging_name = 'patch_staging'
+
+    def __init__(self, model, session, key_columns):
+        self.model = model
+        self.session = session
+        self.key_columns = key_columns
+
+    def stage(self, data):
+        """ Write records to a temp file in `COPY` format; return the file,
+        the record columns, and the columns filled in from their default
+        (e.g. `id`), which are only used for inserts. """
+        columns = None
+        defaults = {}
+        out = tempfile.TemporaryFile('w+', encoding='utf-8')
+        for record in data:
+            if columns is None:
+                record_columns = set(record)
+                for col in self.model.__table__.columns:
+                    if col.name not in record and col.default is not None:
+                        defaults[col.name] = col.default
+                columns = sorted(record)
+            assert set(record) == record_columns, \
+                "All records must have the same columns"
+            values = [record[k] for k in columns]
+            for name in sorted(defaults):
+                default = defaults[name]
+                values.append(default.arg(None) if default.is_callable
+                              else default.arg)
+            out.write('\t'.join(copy_text_value(v) for v in values) + '\n')
+        out.seek(0)
+        return out, columns or [], sorted(defaults)
+
+    def update(self, data, create=True, remove=False):
+        counters = {'n_add': 0, 'n_update': 0,
+                    'n_remove': 0, 'n_ok': 0, 'total': 0}
+        staging_file, record_columns, default_columns = self.stage(data)
+        connection = self.session.connection()
+        quote = connection.dialect.identifier_preparer.quote
+        table = quote(self.model.__table__.name)
+        staging = self.staging_name
+        columns = (record_columns or list(self.key_columns)) + default_columns
+
+        def sql_list(names, prefix=''):
+            return ', '.join(prefix + quote(name) for name in names)
+
+        def execute(sql):
+            return self.session.execute(sql)
+
+        key_match = ' AND '.join('t.{k} = s.{k}'.format(k=quote(k))
+                                 for k in self.key_columns)
+        value_columns = [c for c in record_columns
+                         if c not in self.key_columns]
+
+        [(table_has_rows,)] = execute('SELECT EXISTS (SELECT 1 FROM {table})'
+                                      .format(table=table))
+        if create and not table_has_rows:
+            # nothing to match against; copy straight into the table
+            with staging_file:
+                cursor = connection.connection.cursor()
+                cursor.copy_expert('COPY {table} ({cols}) FROM STDIN'
+                                   .format(table=table,
+                                           cols=sql_list(columns)),
+                                   staging_file)
+            [(counters['n_add'],)] = execute('SELECT count(*) FROM {table}'
+                                             .format(table=table))
+            counters['total'] = counters['n_add']
+            self.session.commit()
+            logger.info("Created %d in empty table.", counters['n_add'])
+            return counters
+
+        with staging_file:
+            execute('CREATE TEMP TABLE {staging} ON COMMIT DROP AS '
+                    'SELECT {cols} FROM {table} WITH NO DATA'
+                    .format(staging=staging, table=table,
+                            cols=sql_list(columns)))
+            cursor = connection.connection.cursor()
+            cursor.copy_expert('COPY {staging} ({cols}) FROM STDIN'
+                               .format(staging=staging,
+                                       cols=sql_list(columns)),
+                               staging_file)
+        execute('ANALYZE {staging}'.format(staging=staging))
+
+        # `count(DISTINCT ...)` skips rows with a null key, so those are
+        # looked for first
+        null_key = ' OR '.join('{k} IS NULL'.format(k=quote(k))
+                               for k in self.key_columns)
+        [(n_null_key,)] = execute(
+            'SELECT count(*) FROM {staging} WHERE {null_key}'
+            .format(staging=staging, null_key=null_key))
+        if n_null_key:
+            self.session.rollback()
+            raise NullKey("%d records have a null key" % n_null_key)
+
+        [(counters['total'], n_distinct)] = execute(
+            'SELECT count(*), count(DISTINCT ({keys})) FROM {staging}'
+            .format(staging=staging, keys=sql_list(self.key_columns)))
+        if counters['total'] != n_distinct:
+            self.session.rollback()
+            raise DuplicateKey("%d records have a duplicate key"
+                               % (counters['total'] - n_distinct))
+
+        [(n_matched,)] = execute(
+            'SELECT count(*) FROM {staging} s JOIN {table} t ON {key_match}'
+            .format(staging=staging, table=table, key_match=key_match))
+        n_missing = counters['total'] - n_matched
+        if n_missing and not create:
+            self.session.rollback()
+            raise RowNotFound("Could not find %d rows" % n_missing)
+
+        if value_columns:
+            changed = ' OR '.join('t.{c} IS DISTINCT FROM s.{c}'
+                                  .format(c=quote(c)) for c in value_columns)
+            assignments = ', '.join('{c} = s.{c}'.format(c=quote(c))
+                                    for c in value_columns)
+            counters['n_update'] = execute(
+                'UPDATE {table} t SET {assignments} FROM {staging} s '
+                'WHERE {key_match} AND ({changed})'
+                .format(table=table, staging=staging, key_match=key_match,
+                        assignments=assignments, changed=changed)).rowcount
+        counters['n_ok'] = n_matched - counters['n_update']
+
+        if n_missing:
+            counters['n_add'] = execute(
+                'INSERT INTO {table} ({cols}) SELECT {s_cols} FROM {staging} s '
+                'WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {key_match})'
+                .format(table=table, staging=staging, key_match=key_match,
+                        cols=sql_list(columns),
+                        s_cols=sql_list(columns, 's.'))).rowcount
+
+        if remove:
+            counters['n_remove'] = execute(
+                'DELETE FROM {table} t WHERE NOT EXISTS '
+                '(SELECT 1 FROM {staging} s WHERE {key_match})'
+                .format(table=table, staging=staging,
+                        key_match=key_match)).rowcount
+
+        self.session.commit()
+        logger.info("Created %d, updated %d, removed %d, found ok %d.",
+                    counters['n_add'], counters['n_update'],
+                    counters['n_remove'], counters['n_ok'])
+        return counters
+
+
+@contextmanager
+def timed(timing, name):
+    t0 = time.time()
+    yield
+    timing[name] = round(time.time() - t0, 3)
+
+
+def pdf_to_text(pdf_bytes, last_page=None):
+    """ run pdftotext from poppler """
+    args = ['pdftotext', '-enc', 'UTF-8']
+    if last_page is not None:
+        args += ['-l', str(last_page)]
+    p = subprocess.Popen(args + ['-', '-'],
+                         stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE)
+    try:
+        outs, errs = p.communicate(pdf_bytes, timeout=PDFTOTEXT_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        p.communicate()
+        raise
+    return outs.decode('utf-8')
+
+
+def pdf_text_pages(pdf_bytes, max_pages):
+    """ Text layer of each page; empty list if the PDF can't be read """
+    try:
+        text = pdf_to_text(pdf_bytes, last_page=max_pages)
+    except (OSError, subprocess.SubprocessError, UnicodeDecodeError):
+        logger.exception("pdftotext failed")
+        return []
+    # pdftotext ends every page with a form feed
+    return text.split('\f')[:-1][:max_pages]
+
+
+def has_text_layer(page_text):
+    return len(''.join(page_text.split())) >= MIN_TEXT_LAYER_CHARS
+
+
+def ocr_image(image_path):
+    # one tesseract thread per process; we run several processes instead
+    env = dict(os.environ, OMP_THREAD_LIMIT='1')
+    subprocess.check_call(['tesseract',
+                           image_path, image_path,
+                           '-l', OCR_LANGUAGE],
+                          stderr=subprocess.DEVNULL, env=env)
+    return (image_path + '.txt').text()
+
+
+def ocr_pdf_page(pdf_path, page_number, tmp):
+    root = 'page-%03d' % page_number
+    subprocess.check_call(['pdfimages',
+                           '-f', str(page_number), '-l', str(page_number),
+                           pdf_path, tmp / root])
+    image_paths = sorted(tmp.listdir(root + '-*'))
+    return '\n\n'.join(ocr_image(image_path) for image_path in image_paths)
+
+
+def ocr_cache_path(pdf_data, max_pages):
+    """ OCR results are stored by a hash of the PDF and the OCR settings """
+    digest = hashlib.sha256(pdf_data)
+    digest.update(('\n%d\n%s' % (max_pages, OCR_LANGUAGE)).encode('utf-8'))
+    key = digest.hexdigest()
+    cache_dir = path(flask.current_app.config['DATA_DIR']) / 'ocr-cache'
+    return cache_dir / key[:2] / (key + '.json')
+
+
+def load_cached_ocr(cache_path):
+    if not cache_path.isfile():
+        return None
+    with cache_path.open('r', encoding='utf-8') as f:
+        doc = flask.json.load(f)
+    doc.setdefault('page_sources', ['ocr'] * len(doc['pages']))
+    return doc
+
+
+def save_cached_ocr(cache_path, doc):
+    cache_path.parent.makedirs_p()
+    tmp_path = cache_path + '.tmp-%d' % os.getpid()
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        flask.json.dump(doc, f)
+    os.rename(tmp_path, cache_path)
 
 
 @job
-def ocr_url(url, max_pages=MAX_OCR_PAGES):
+def ocr_url(url, max_pages=MAX_OCR_PAGES, workers=None):
+    """ Get the text of a PDF. Pages with a text layer are read with
+    `pdftotext`, the rest go through `tesseract`; `page_sources` in the
+    result says which path each page took. """
     from mptracker.scraper.common import create_session
 
     pdf_cache_name = flask.current_app.config.get('MPTRACKER_PDF_CACHE')
     http_session = create_session(cache_name=pdf_cache_name, throttle=0.5)
+    timing = {}
 
-    with temp_dir() as tmp:
+    with timed(timing, 'fetch'):
         pdf_data = http_session.get(url).content
+
+    cache_path = ocr_cache_path(pdf_data, max_pages)
+    doc = load_cached_ocr(cache_path)
+    if doc is not None:
+        return dict(doc, timing=timing, cached=True)
+
+    with temp_dir() as tmp:
         pdf_path = tmp / 'document.pdf'
         with pdf_path.open('wb') as f:
             f.write(pdf_data)
-        subprocess.check_call(['pdfimages', pdf_path, tmp / 'img'])
-
-        pages = []
-        for image_path in sorted(tmp.listdir('img-*'))[:MAX_OCR_PAGES]:
-            subprocess.check_call(['tesseract',
-                                   image_path, image_path,
-                                   '-l', 'ron'],
-                                  stderr=subprocess.DEVNULL)
-            text = (image_path + '.txt').text()
-            pages.append(text)
 
-        return pages
+        with timed(timing, 'text_layer'):
+            pages = pdf_text_pages(pdf_data, max_pages)
+        page_sources = ['text' if has_text_layer(text) else 'ocr'
+                        for text in pages]
+
+        with timed(timing, 'ocr'):
+            with ThreadPoolExecutor(workers or cpu_count()) as executor:
+                if pages:
+                    ocr_numbers = [n for n, source in enumerate(page_sources)
+                                   if source == 'ocr']
+                    ocr_texts = executor.map(
+                        lambda n: ocr_pdf_page(pdf_path, n + 1, tmp),
+                        ocr_numbers)
+                    for n, text in zip(ocr_numbers, ocr_texts):
+                        pages[n] = text
+
+                else:
+                    # no page information; OCR whatever images we find
+                    subprocess.check_call(['pdfimages',
+                                           '-l', str(max_pages),
+                                           pdf_path, tmp / 'img'])
+                    image_paths = sorted(tmp.listdir('img-*'))[:max_pages]
+                    pages = list(executor.map(ocr_image, image_paths))
+                    page_sources = ['ocr'] * len(pages)
+
+    doc = {'pages': pages, 'page_sources': page_sources}
+    save_cached_ocr(cache_path, doc)
+    return dict(doc, timing=timing, cached=False)
 
 
 def csv_lines(cols, rows):
@@ -196,3 +676,69 @@ def csv_lines(cols, rows):
         writer.writerow(r)
         yield out.getvalue()
         out.seek(out.truncate(0))
+
+
+class InvalidCursor(ValueError):
+    """ Page cursor that was not made by `encode_cursor` for this listing. """
+
+
+def encode_cursor(values):
+    data = flask.json.dumps(list(values)).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        values = flask.json.loads(data.decode('utf-8'))
+    except ValueError:
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values
+
+
+def keyset_filter(sort_keys, values):
+    """ Match the rows that sort after `values`, given `(column, descending)`
+    sort keys """
+    clauses = []
+    for n, ((column, descending), value) in enumerate(zip(sort_keys, values)):
+        equal = [c == v for ((c, _), v) in zip(sort_keys[:n], values[:n])]
+        after = (column < value) if descending else (column > value)
+        clauses.append(and_(*(equal + [after])))
+    return or_(*clauses)
+
+
+def keyset_page(query, sort_keys, row_key, cursor=None, limit=PAGE_SIZE):
+    """ Return up to `limit` rows of `query` that come after `cursor`, and
+    the cursor for the next page, or `None` on the last page. The columns
+    in `sort_keys` must be unique together; `row_key` returns their values
+    for a row. """
+    order = []
+    for column, descending in sort_keys:
+        order.append(column.desc() if descending else column)
+    if cursor is not None:
+        values = decode_cursor(cursor)
+        if len(values) != len(sort_keys):
+            raise InvalidCursor(cursor)
+        query = query.filter(keyset_filter(sort_keys, values))
+    rows = query.order_by(*order).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(row_key(rows[limit - 1]))
+    return rows, None
+
+
+def paginate(query, sort_keys, row_key):
+    """ `keyset_page` with the cursor and page size taken from the `after`
+    and `limit` request arguments """
+    args = flask.request.args
+    limit = min(max(1, args.get('limit', PAGE_SIZE, type=int)), MAX_PAGE_SIZE)
+    try:
+        return keyset_page(query, sort_keys, row_key,
+                           args.get('after'), limit)
+    except InvalidCursor:
+        flask.abort(400)
+
+
+def wants_json():
+    return flask.request.args.get('format') == 'json'
@@ -1,17 +1,25 @@
 import sys
 import os
+import gzip
+import shutil
+import hashlib
+import threading
 import logging
 import uuid
 import argparse
 from datetime import datetime
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import flask
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.script import Manager
 from flask.ext.login import UserMixin
 from path import path
-from mptracker.common import (parse_date, TablePatcher, temp_dir,
-                              fix_local_chars)
+from mptracker.common import (parse_date, TablePatcher, BulkTablePatcher,
+                              temp_dir, fix_local_chars)
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.types import UserDefinedType
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -27,6 +35,12 @@ def identity(v):
     return v
 
 
+class TsVector(UserDefinedType):
+
+    def get_col_spec(self):
+        return 'TSVECTOR'
+
+
 class Chamber(db.Model):
     id = db.Column(UUID, primary_key=True, default=random_uuid)
     slug = db.Column(db.Text, index=True)
@@ -126,6 +140,23 @@ class Mandate(db.Model):
                 "?idm={m.cdep_number}&cam=2&leg={m.year}".format(m=self))
 
 
+class MandateStats(db.Model):
+    """ Activity counts for a mandate, kept up to date by the code that
+    writes questions, stenograms, sponsorships and matches; see
+    `refresh_mandate_stats`. """
+
+    id = db.Column(UUID, db.ForeignKey('mandate.id'), primary_key=True)
+    mandate = db.relationship('Mandate',
+        backref=db.backref('stats', uselist=False))
+    question_count = db.Column(db.Integer, nullable=False, default=0,
+                               index=True)
+    interpelation_count = db.Column(db.Integer, nullable=False, default=0)
+    paragraph_count = db.Column(db.Integer, nullable=False, default=0)
+    sponsorship_count = db.Column(db.Integer, nullable=False, default=0)
+    local_question_count = db.Column(db.Integer, nullable=False, default=0)
+    local_score = db.Column(db.Float, nullable=False, default=0)
+
+
 class County(db.Model):
     id = db.Column(UUID, primary_key=True, default=random_uuid)
     name = db.Column(db.Text)
@@ -143,6 +174,7 @@ class StenoChapter(db.Model):
     date = db.Column(db.Date, index=True)
     headline = db.Column(db.Text)
     serial = db.Column(db.Text, index=True)
+    content_hash = db.Column(db.Text)
 
     @property
     def serial_number(self):
@@ -158,7 +190,7 @@ class StenoParagraph(db.Model):
     chapter = db.relationship('StenoChapter',
         backref=db.backref('paragraphs', lazy='dynamic'))
 
-    mandate_id = db.Column(UUID, db.ForeignKey('mandate.id'))
+    mandate_id = db.Column(UUID, db.ForeignKey('mandate.id'), index=True)
     mandate = db.relationship('Mandate',
         backref=db.backref('steno_paragraphs', lazy='dynamic'))
 
@@ -174,7 +206,7 @@ class Question(db.Model):
     method = db.Column(db.Text)
     addressee = db.Column(db.Text)
 
-    mandate_id = db.Column(UUID, db.ForeignKey('mandate.id'))
+    mandate_id = db.Column(UUID, db.ForeignKey('mandate.id'), index=True)
     mandate = db.relationship('Mandate',
         backref=db.backref('questions', lazy='dynamic'))
 
@@ -234,12 +266,40 @@ class Match(db.Model):
     id = db.Column(UUID, primary_key=True)
     parent = db.Column(db.Text, nullable=False)
     data = db.Column(db.Text)
-    score = db.Column(db.Float)
+    score = db.Column(db.Float, index=True)
 
     @classmethod
     def all_ids_for(cls, parent):
         return set(row.id for row in cls.query.filter_by(parent=parent))
 
+    @classmethod
+    def save_results(cls, parent, results, existing_ids):
+        """ Write `(id, result)` pairs with bulk statements; the caller
+        commits. """
+        table = cls.__table__
+        new_rows = []
+        changed_rows = []
+        for id, result in results:
+            data = flask.json.dumps(result)
+            score = len(result['top_matches'])
+            if id in existing_ids:
+                changed_rows.append({'match_id': id, 'match_data': data,
+                                     'match_score': score})
+            else:
+                new_rows.append({'id': id, 'parent': parent,
+                                 'data': data, 'score': score})
+
+        if changed_rows:
+            update = (table.update()
+                           .where(table.c.id == db.bindparam('match_id'))
+                           .values(data=db.bindparam('match_data'),
+                                   score=db.bindparam('match_score')))
+            db.session.execute(update, changed_rows)
+        if new_rows:
+            db.session.execute(table.insert(), new_rows)
+
+        existing_ids.update(row['id'] for row in new_rows)
+
 
 class QuestionFlags(db.Model):
     id = db.Column(UUID, db.ForeignKey('question.id'), primary_key=True)
@@ -256,6 +316,17 @@ class CommitteeSummary(db.Model):
     text = db.Column(db.Text)
 
 
+class SearchDocument(db.Model):
+    """ Full-text index entry; `id` is the id of the indexed row. """
+    id = db.Column(UUID, primary_key=True)
+    parent = db.Column(db.Text, nullable=False, index=True)
+    vector = db.Column(TsVector)
+
+    __table_args__ = (
+        db.Index('ix_search_document_vector', 'vector',
+                 postgresql_using='gin'),
+    )
+
 
 class Sponsorship(db.Model):
     id = db.Column(UUID, primary_key=True, default=random_uuid)
@@ -264,7 +335,8 @@ class Sponsorship(db.Model):
     proposal = db.relationship('Proposal', lazy='eager',
         backref=db.backref('sponsorships', lazy='dynamic', cascade='all'))
 
-    mandate_id = db.Column(UUID, db.ForeignKey('mandate.id'), nullable=False)
+    mandate_id = db.Column(UUID, db.ForeignKey('mandate.id'), nullable=False,
+                           index=True)
     mandate = db.relationship('Mandate',
         backref=db.backref('sponsorships', lazy='dynamic', cascade='all'))
 
@@ -326,6 +398,68 @@ class User(db.Model, UserMixin):
             return row
 
 
+def refresh_mandate_stats(mandate_ids=None):
+    """ Recompute `MandateStats` for the given mandates, or for all of them;
+    the caller commits. """
+    session = db.session
+    session.flush()  # the session doesn't autoflush
+    refresh_all = mandate_ids is None
+    if not refresh_all:
+        mandate_ids = set(mandate_ids) - {None}
+        if not mandate_ids:
+            return
+
+    def grouped(query, mandate_column):
+        query = query.group_by(mandate_column)
+        if not refresh_all:
+            query = query.filter(mandate_column.in_(mandate_ids))
+        return query
+
+    if refresh_all:
+        mandate_ids = set(id for (id,) in session.query(Mandate.id))
+    stats = {id: {'id': id, 'question_count': 0, 'interpelation_count': 0,
+                  'paragraph_count': 0, 'sponsorship_count': 0,
+                  'local_question_count': 0, 'local_score': 0}
+             for id in mandate_ids}
+
+    for (mandate_id, question_type, count) in grouped(
+            session.query(Question.mandate_id, Question.type,
+                          db.func.count(Question.id))
+                   .group_by(Question.type),
+            Question.mandate_id):
+        if mandate_id in stats:
+            key = ('interpelation_count' if question_type == 'interpelation'
+                   else 'question_count')
+            stats[mandate_id][key] += count
+
+    for (mandate_id, n_local, score) in grouped(
+            session.query(Question.mandate_id,
+                          db.func.count(Match.id),
+                          db.func.coalesce(db.func.sum(Match.score), 0))
+                   .join(Match, Match.id == Question.id)
+                   .filter(Match.score > 0),
+            Question.mandate_id):
+        if mandate_id in stats:
+            stats[mandate_id]['local_question_count'] = n_local
+            stats[mandate_id]['local_score'] = score
+
+    for model, key in [(StenoParagraph, 'paragraph_count'),
+                       (Sponsorship, 'sponsorship_count')]:
+        for (mandate_id, count) in grouped(
+                session.query(model.mandate_id, db.func.count(model.id)),
+                model.mandate_id):
+            if mandate_id in stats:
+                stats[mandate_id][key] = count
+
+    table = MandateStats.__table__
+    if refresh_all:
+        session.execute(table.delete())
+    else:
+        session.execute(table.delete().where(table.c.id.in_(stats)))
+    if stats:
+        session.execute(table.insert(), list(stats.values()))
+
+
 class MandateLookup:
     """ Find the right person+mandate based on name, year and cdep_number """
 
@@ -344,9 +478,52 @@ class MandateLookup:
         return mandate
 
 
+class SpeakerIndex:
+    """ Resolve stenogram speakers to mandate ids, by cdep id, or failing
+    that by name within the legislature; names that can't be resolved are
+    counted in `unresolved`. """
+
+    def __init__(self):
+        query = (db.session.query(Mandate.id, Mandate.year,
+                                  Mandate.cdep_number, Person.name)
+                           .join(Mandate.person))
+        self.by_cdep_id = {}
+        self.by_name = {}
+        for (id, year, cdep_number, name) in query:
+            self.by_cdep_id['%d-%03d' % (year, cdep_number)] = id
+            key = (year, self.name_key(name))
+            # two people with the same name can't be told apart
+            self.by_name[key] = None if key in self.by_name else id
+        self.years = sorted(set(year for (year, _) in self.by_name))
+        self.unresolved = Counter()
+
+    def name_key(self, name):
+        return frozenset(fix_local_chars(name).lower()
+                                              .replace('-', ' ').split())
+
+    def legislature(self, day):
+        i = bisect_right(self.years, day.year)
+        return self.years[i - 1] if i else None
+
+    def find(self, speaker_cdep_id, speaker_name, day):
+        mandate_id = self.by_cdep_id.get(speaker_cdep_id)
+        if mandate_id is None and speaker_name:
+            key = (self.legislature(day), self.name_key(speaker_name))
+            mandate_id = self.by_name.get(key)
+        if mandate_id is None:
+            self.unresolved[speaker_name or speaker_cdep_id] += 1
+        return mandate_id
+
+
 db_manager = Manager()
 
 
+@db_manager.command
+def rebuild_mandate_stats():
+    refresh_mandate_stats()
+    db.session.commit()
+
+
 @db_manager.command
 def sync():
     db.create_all()
@@ -424,25 +601,40 @@ def empty(name):
     db.session.commit()
 
 
-@db_manager.command
-def dump(name, columns=None, number=None, filter=None, _file=sys.stdout):
-    if columns:
-        columns = columns.split(',')
+dump_encoder = flask.json.JSONEncoder(sort_keys=True)
+
+
+def iter_dump(name, columns=None, filter=None):
+    """ Yield `(id, json_line)` for each row of the table, in id order """
     loader = TableLoader(name)
-    count = 0
-    query = loader.model.query
+    table = loader.model.__table__
+    query = db.session.query(*table.columns)
 
     if filter:
         for filter_spec in filter.split(','):
             if '=' in filter_spec:
                 name, value = filter_spec.split('=', 1)
-                query = query.filter(getattr(loader.model, name) == value)
+                query = query.filter(table.c[name] == value)
             else:
                 name = filter_spec
-                query = query.filter(getattr(loader.model, name) != None)
+                query = query.filter(table.c[name] != None)
 
-    for row in query.order_by('id'):
-        flask.json.dump(loader.to_dict(row, columns), _file, sort_keys=True)
+    # plain column tuples, streamed from a server-side cursor
+    rows = (query.order_by(table.c.id)
+                 .execution_options(stream_results=True)
+                 .yield_per(1000))
+    encode = dump_encoder.encode
+    for row in rows:
+        yield row.id, encode(loader.to_dict(row, columns))
+
+
+@db_manager.command
+def dump(name, columns=None, number=None, filter=None, _file=sys.stdout):
+    if columns:
+        columns = columns.split(',')
+    count = 0
+    for _, line in iter_dump(name, columns, filter):
+        _file.write(line)
         _file.write('\n')
         count += 1
         if number is not None:
@@ -453,7 +645,8 @@ def dump(name, columns=None, number=None, filter=None, _file=sys.stdout):
 
 
 @db_manager.command
-def load(name, include_columns=None, create=True, remove=False):
+def load(name, include_columns=None, create=True, remove=False, bulk=False,
+         _file=sys.stdin):
     if include_columns:
         include_columns = set(include_columns.split(','))
         def filter_record(r):
@@ -461,51 +654,278 @@ def load(name, include_columns=None, create=True, remove=False):
     else:
         filter_record = lambda r: r
     loader = TableLoader(name)
-    patcher = TablePatcher(loader.model, db.session, key_columns=['id'])
+    patcher_cls = BulkTablePatcher if bulk else TablePatcher
+    patcher = patcher_cls(loader.model, db.session, key_columns=['id'])
     records = (filter_record(loader.decode_dict(flask.json.loads(line)))
-               for line in sys.stdin)
-    patcher.update(records, create=create, remove=remove)
+               for line in _file)
+    return patcher.update(records, create=create, remove=remove)
 
 
-@db_manager.command
-def dump_tables(folder_path=None, xclude=None):
-    if folder_path is None:
-        folder_path = os.environ['MPTRACKER_DUMP_TABLES_FOLDER']
+# computed from the other tables; left out of dumps and rebuilt after loading
+derived_tables = ['mandate_stats', 'search_document']
+
+
+def dump_table_names(xclude=None):
     if xclude is None:
         xclude = os.environ.get('MPTRACKER_DUMP_TABLES_EXCLUDE')
     if xclude:
         exclude = xclude.split(',')
     else:
         exclude = []
+    exclude += derived_tables
+    return sorted(name for name in get_model_map() if name not in exclude)
+
+
+def rebuild_derived_tables():
+    from mptracker.search import reindex
+    refresh_mandate_stats()
+    db.session.commit()
+    reindex()
+
+
+@db_manager.command
+def dump_tables(folder_path=None, xclude=None, workers='4', compress=False):
+    """ Dump each table to `<name>.json`, or `<name>.json.gz` with
+    `--compress`; tables are dumped concurrently, each on its own
+    connection. """
+    if folder_path is None:
+        folder_path = os.environ['MPTRACKER_DUMP_TABLES_FOLDER']
     folder_path = path(folder_path)
-    model_map = get_model_map()
-    for name in model_map:
-        if name in exclude:
+    names = dump_table_names(xclude)
+    app = flask.current_app._get_current_object()
+
+    def dump_table(name):
+        # the session is scoped to the thread, and removed along with the
+        # app context
+        with app.app_context():
+            file_path = folder_path / ('%s.json' % name)
+            if compress:
+                file_path += '.gz'
+                table_fd = gzip.open(file_path, 'wt', encoding='utf-8',
+                                     compresslevel=6)
+            else:
+                table_fd = open(file_path, 'w', encoding='utf-8')
+            with table_fd:
+                return name, dump(name, _file=table_fd)
+
+    with ThreadPoolExecutor(int(workers)) as executor:
+        for name, count in executor.map(dump_table, names):
+            print(name, '...', count, 'rows')
+
+
+def table_load_levels(names):
+    """ Group tables so that each one comes after the tables it refers to;
+    tables in the same group can be loaded at the same time. """
+    level = {}
+    for table in db.metadata.sorted_tables:
+        if table.name not in names:
             continue
-        print(name, end=' ... ')
-        file_name = '%s.json' % name
-        file_path = folder_path / file_name
-        with open(file_path, 'w', encoding='utf-8') as table_fd:
-            count = dump(name, _file=table_fd)
-        print(count, 'rows')
+        parents = set(fk.column.table.name for fk in table.foreign_keys)
+        level[table.name] = 1 + max([level[p] for p in parents
+                                     if p in level and p != table.name] +
+                                    [-1])
+    levels = [[] for n in range(max(level.values()) + 1 if level else 0)]
+    for name in sorted(level):
+        levels[level[name]].append(name)
+    return levels
+
+
+@db_manager.command
+def load_tables(folder_path=None, xclude=None, workers='4'):
+    """ Load the `<name>.json` or `<name>.json.gz` files written by
+    `dump_tables`, with `COPY`; tables are loaded concurrently, each on its
+    own connection, parents before children. Empty tables are copied into
+    directly, others are patched like `load --bulk` does. The derived
+    tables are rebuilt afterwards. """
+    if folder_path is None:
+        folder_path = os.environ['MPTRACKER_DUMP_TABLES_FOLDER']
+    folder_path = path(folder_path)
+    app = flask.current_app._get_current_object()
 
+    table_files = {}
+    for name in dump_table_names(xclude):
+        for file_name in ['%s.json.gz' % name, '%s.json' % name]:
+            if (folder_path / file_name).isfile():
+                table_files[name] = folder_path / file_name
+                break
+
+    def load_table(name):
+        with app.app_context():
+            file_path = table_files[name]
+            if file_path.endswith('.gz'):
+                table_fd = gzip.open(file_path, 'rt', encoding='utf-8')
+            else:
+                table_fd = open(file_path, encoding='utf-8')
+            with table_fd:
+                return name, load(name, bulk=True, _file=table_fd)
 
-def create_backup(backup_path):
+    with ThreadPoolExecutor(int(workers)) as executor:
+        for names in table_load_levels(set(table_files)):
+            for name, counters in executor.map(load_table, names):
+                print(name, '...', counters['n_add'], 'added,',
+                      counters['n_update'], 'updated')
+
+    rebuild_derived_tables()
+    print("rebuilt", ', '.join(derived_tables))
+
+
+def create_backup(backup_path, workers=4):
     import zipfile
     with temp_dir() as tmp:
+        dump_path = tmp / 'dump'
+        dump_path.mkdir()
+        dump_tables(dump_path, workers=workers, compress=True)
         zip_path = tmp / 'dump.zip'
-        zip_archive = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
-        dump_tables(tmp)
-        for file_path in tmp.listdir():
-            zip_archive.write(file_path, file_name)
-        zip_archive.close()
-        zip_path.rename(backup_path)
+        # table dumps are already compressed
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_archive:
+            for file_path in dump_path.listdir():
+                zip_archive.write(file_path, file_path.name)
+        shutil.move(zip_path, backup_path)
+
+
+BACKUP_CHUNK_ROWS = 1000
+
+
+def chunk_boundary(row_id, chunk_rows=BACKUP_CHUNK_ROWS):
+    """ Chunks end after rows picked by a hash of their id, so adding or
+    removing a row only changes the chunk it falls in. """
+    digest = hashlib.md5(str(row_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:4], 'big') % chunk_rows == 0
+
+
+class ChunkStore:
+    """ Gzipped chunks of table dumps, stored by the sha256 of their
+    content, and manifests listing each table's chunks for a backup. """
+
+    def __init__(self, root):
+        self.root = path(root)
+
+    def chunk_path(self, digest):
+        return self.root / 'chunks' / digest[:2] / (digest + '.json.gz')
+
+    def put(self, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        chunk_path = self.chunk_path(digest)
+        if chunk_path.isfile():
+            return digest, False
+        chunk_path.parent.makedirs_p()
+        tmp_path = chunk_path + '.%d.tmp' % threading.get_ident()
+        with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+            f.write(data)
+        tmp_path.rename(chunk_path)
+        return digest, True
+
+    def get(self, digest):
+        with gzip.open(self.chunk_path(digest), 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def manifest_path(self, name):
+        return self.root / 'manifests' / (name + '.json')
+
+    def manifest_names(self):
+        manifest_dir = self.root / 'manifests'
+        if not manifest_dir.isdir():
+            return []
+        return sorted(p.namebase for p in manifest_dir.files('*.json'))
+
+    def save_manifest(self, name, manifest):
+        manifest_path = self.manifest_path(name)
+        manifest_path.parent.makedirs_p()
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            flask.json.dump(manifest, f, sort_keys=True, indent=2)
+
+    def load_manifest(self, name):
+        with open(self.manifest_path(name), encoding='utf-8') as f:
+            return flask.json.load(f)
+
+
+def get_chunk_store():
+    return ChunkStore(path(os.environ['BACKUP_DIR']) / 'incremental')
+
+
+def create_incremental_backup(store, workers=4):
+    """ Dump every table into chunks, writing only chunks that aren't in
+    the store already, and record them in a new manifest. """
+    app = flask.current_app._get_current_object()
+
+    def backup_table(name):
+        with app.app_context():
+            chunks = []
+            buffer = []
+            n_rows = n_new = 0
+
+            def flush():
+                nonlocal n_new
+                digest, is_new = store.put(''.join(buffer))
+                chunks.append(digest)
+                n_new += int(is_new)
+                del buffer[:]
+
+            for row_id, line in iter_dump(name):
+                buffer.append(line + '\n')
+                n_rows += 1
+                if chunk_boundary(row_id):
+                    flush()
+            if buffer:
+                flush()
+            return name, {'rows': n_rows, 'chunks': chunks}, n_new
+
+    manifest = {'created': datetime.utcnow().isoformat(), 'tables': {}}
+    with ThreadPoolExecutor(workers) as executor:
+        for name, table_info, n_new in executor.map(backup_table,
+                                                    dump_table_names()):
+            manifest['tables'][name] = table_info
+            print(name, '...', table_info['rows'], 'rows,', n_new, 'new of',
+                  len(table_info['chunks']), 'chunks')
+
+    manifest_name = datetime.utcnow().strftime('%Y-%m-%d-%H%M%S')
+    store.save_manifest(manifest_name, manifest)
+    return manifest_name
 
 
 @db_manager.command
-def backup():
+def backup(workers='4', incremental=False):
+    """ Write a full backup zip to `BACKUP_DIR`; with `--incremental`,
+    store only the chunks that changed since earlier backups, see
+    `restore_backup`. """
+    if incremental:
+        store = get_chunk_store()
+        manifest_name = create_incremental_backup(store, int(workers))
+        print("Backup manifest at %s" % store.manifest_path(manifest_name))
+        return
+
     backup_dir = path(os.environ['BACKUP_DIR'])
     backup_name = datetime.utcnow().strftime('backup-%Y-%m-%d-%H%M%S.zip')
     backup_path = backup_dir / backup_name
-    create_backup(backup_path)
+    create_backup(backup_path, workers=int(workers))
     print("Backup at %s (%d bytes)" % (backup_path, backup_path.size))
+
+
+@db_manager.command
+def restore_backup(manifest=None, folder_path=None, load_data=False):
+    """ Reassemble an incremental backup, the latest one unless `manifest`
+    is given, into `<name>.json` files in `folder_path`, the same as
+    `dump_tables` writes; with `--load_data`, load them into the database
+    too, see `load_tables`. """
+    if folder_path is None and not load_data:
+        raise RuntimeError("Need folder_path or --load_data")
+    store = get_chunk_store()
+    if manifest is None:
+        manifest_names = store.manifest_names()
+        if not manifest_names:
+            raise RuntimeError("No backups found in %s" % store.root)
+        manifest = manifest_names[-1]
+    tables = store.load_manifest(manifest)['tables']
+
+    with temp_dir() as tmp:
+        folder_path = path(folder_path or tmp)
+        for name, table_info in tables.items():
+            with open(folder_path / ('%s.json' % name), 'w',
+                      encoding='utf-8') as table_fd:
+                for digest in table_info['chunks']:
+                    table_fd.write(store.get(digest))
+            print(name, '...', table_info['rows'], 'rows')
+
+        if load_data:
+            load_tables(folder_path, xclude='')
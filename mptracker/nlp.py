@@ -1,8 +1,15 @@
 import re
+import multiprocessing
 from collections import namedtuple, defaultdict
-from mptracker.placenames import get_county_data, get_minority_names
+from functools import lru_cache
+import flask
+from mptracker.placenames import (get_county_data, county_data_path,
+                                  minority_data_path, file_version,
+                                  load_json_version)
 
 Token = namedtuple('Token', ['text', 'start', 'end'])
+MatchJob = namedtuple('MatchJob', ['id', 'text', 'person_name',
+                                   'minority', 'county_code'])
 ANY_PUNCTUATION = r'[.,;!?\-()]*'
 word_pattern = re.compile(r'\b' + ANY_PUNCTUATION +
                           r'(?P<word>\S+?)' +
@@ -103,69 +110,141 @@ def prepare_names(name_list):
     return sorted(out.items())
 
 
-def match_names(text, name_list, mp_info={}):
-    MP_TITLE_LOOKBEHIND_TOKENS = 7
+class NameMatcher:
+    """ Find names from a fixed list in text, using a precompiled trie """
 
-    name_data = prepare_names(name_list)
+    MP_TITLE_LOOKBEHIND_TOKENS = 7
 
-    matches = []
-    tokens = list(tokenize(text))
-    for idx in range(len(tokens)):
-        token_matches = []
-        for word_count, counted_name_list in name_data:
-            if idx + word_count > len(tokens):
+    def __init__(self, name_list):
+        # each name is a path of normalized, space-separated pieces; the
+        # terminal node, keyed on `None`, holds (word_count, name)
+        self.trie = {}
+        for word_count, counted_name_list in prepare_names(name_list):
+            for norm_name, name in counted_name_list.items():
+                node = self.trie
+                for piece in norm_name.split(' '):
+                    node = node.setdefault(piece, {})
+                node[None] = (word_count, name)
+
+    def walk(self, token_pieces, idx):
+        node = self.trie
+        for offset, pieces in enumerate(token_pieces[idx:]):
+            for piece in pieces:
+                node = node.get(piece)
+                if node is None:
+                    return
+            if None in node:
+                (word_count, name) = node[None]
+                if word_count == offset + 1:
+                    yield (word_count, name)
+
+    def match(self, text, mp_info={}):
+        tokens = list(tokenize(text))
+        norm_tokens = [normalize(t.text) for t in tokens]
+        plain_pieces = [n.split(' ') for n in norm_tokens]
+        stem_pieces = [[simple_stem(w) for w in n.split()]
+                       for n in norm_tokens]
+
+        mp_county_name = normalize(mp_info.get('county_name') or '')
+        mp_name_bits = [t.text for t in tokenize(mp_info.get('name', ''))]
+        signature_bits = set(normalize(word) for word in
+                             mp_name_bits + signature_stop_words)
+
+        matches = []
+        for idx in range(len(tokens)):
+            # ties on name length go to the longest window, then to the
+            # stemmed variant, same as the bucketed search did
+            token_matches = []
+            for stem, token_pieces in [(False, plain_pieces),
+                                       (True, stem_pieces)]:
+                for word_count, name in self.walk(token_pieces, idx):
+                    token_matches.append((len(name), word_count, stem, name))
+
+            if not token_matches:
                 continue
-            token_window = tokens[idx : idx + word_count]
-            token = join_tokens(token_window)
-
-            for stem in [False, True]:
-                norm_token = normalize(token.text, stem=stem)
-                if norm_token in counted_name_list:
-                    distance = 1.0
-                    token_matches.append({
-                        'distance': distance,
-                        'name': counted_name_list[norm_token],
-                        'token': token,
-                    })
-
-        if not token_matches:
-            continue
 
-        token_matches.sort(key=lambda m: len(m['name']))
-        top_match = token_matches[-1]
+            (_, word_count, _, name) = max(token_matches)
+            top_match = {
+                'distance': 1.0,
+                'name': name,
+                'token': join_tokens(tokens[idx : idx + word_count]),
+            }
 
-        if (normalize(top_match['name']) ==
-                normalize(mp_info.get('county_name') or '')):
-            mp_name_bits = [t.text for t in tokenize(mp_info.get('name', ''))]
-            signature_bits = set(normalize(word) for word in
-                                 mp_name_bits + signature_stop_words)
+            if normalize(name) == mp_county_name:
+                lookbehind = max(0, idx - self.MP_TITLE_LOOKBEHIND_TOKENS)
+                recent_text_bits = set(norm_tokens[lookbehind:idx])
 
-            recent_tokens = tokens[:idx][- MP_TITLE_LOOKBEHIND_TOKENS:]
-            recent_text_bits = set(normalize(t.text) for t in recent_tokens)
+                if len(signature_bits & recent_text_bits) > 0:
+                    continue
 
-            if len(signature_bits & recent_text_bits) > 0:
-                continue
+            matches.append(top_match)
 
-        matches.append(top_match)
+        return matches
 
-    return matches
 
+def match_names(text, name_list, mp_info={}):
+    return NameMatcher(name_list).match(text, mp_info=mp_info)
 
-def match_text_for_mandate(mandate, text):
-    mp_info = {'name': mandate.person.name}
 
-    if mandate.minority:
-        local_names = get_minority_names()['search_names']
+@lru_cache(100)
+def load_matcher(json_path, version, names_key):
+    data = load_json_version(json_path, version)
+    return NameMatcher(data[names_key] + other_phrases)
 
-    else:
-        county_data = get_county_data(mandate.county.geonames_code)
-        local_names = county_data['place_names']
-        mp_info['county_name'] = county_data['name']
 
-    all_names = local_names + other_phrases
+def get_county_matcher(code):
+    json_path = county_data_path(code)
+    return load_matcher(json_path, file_version(json_path), 'place_names')
+
+
+def get_minority_matcher():
+    json_path = minority_data_path()
+    return load_matcher(json_path, file_version(json_path), 'search_names')
+
+
+def match_text(text, person_name, minority, county_code):
+    mp_info = {'name': person_name}
+
+    if minority:
+        matcher = get_minority_matcher()
 
-    matches = match_names(text, all_names, mp_info=mp_info)
+    else:
+        matcher = get_county_matcher(county_code)
+        mp_info['county_name'] = get_county_data(county_code)['name']
+
+    matches = matcher.match(text, mp_info=mp_info)
     top_matches = sorted(matches,
                          key=lambda m: m['distance'],
                          reverse=True)[:10]
     return {'top_matches': top_matches}
+
+
+def match_text_for_mandate(mandate, text):
+    county_code = None if mandate.minority else mandate.county.geonames_code
+    return match_text(text, mandate.person.name, mandate.minority,
+                      county_code)
+
+
+def init_match_worker(import_name):
+    # placename data is located relative to the app's root path
+    flask.Flask(import_name).app_context().push()
+
+
+def run_match_job(job):
+    result = match_text(job.text, job.person_name,
+                        job.minority, job.county_code)
+    return (job.id, result)
+
+
+def match_in_chunks(job_ids, load_jobs, workers=None, chunk_size=500):
+    """ Match texts in a process pool; `load_jobs` turns a chunk of ids
+    into `MatchJob` tuples, and we yield `(id, result)` pairs per chunk. """
+    pool = multiprocessing.Pool(workers, initializer=init_match_worker,
+                                initargs=[flask.current_app.import_name])
+    try:
+        for offset in range(0, len(job_ids), chunk_size):
+            chunk_ids = job_ids[offset : offset + chunk_size]
+            yield pool.map(run_match_job, list(load_jobs(chunk_ids)))
+
+    finally:
+        pool.terminate()
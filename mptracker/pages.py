@@ -1,11 +1,11 @@
 from collections import defaultdict
 import calendar
-from datetime import datetime
+from datetime import datetime, date
 import flask
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, contains_eager
 from path import path
 from mptracker import models
-from mptracker.common import parse_date
+from mptracker.common import parse_date, paginate, wants_json
 
 
 pages = flask.Blueprint('pages', __name__)
@@ -29,54 +29,108 @@ def home():
     return flask.render_template('home.html')
 
 
+steno_calendar_months = [(2012, 12)] + [(2013, m) for m in range(1, 8)]
+
+
 @pages.route('/steno/')
 def steno_index():
-    people = models.Person.query.order_by('name')
-    date_query = models.db.session.query(models.StenoChapter.date)
-    steno_days = set(row[0] for row in date_query.distinct())
+    Chapter = models.StenoChapter
+    date_query = models.db.session.query(Chapter.date).distinct()
+    if wants_json():
+        days, next_after = paginate(date_query, [(Chapter.date, False)],
+                                    lambda row: [row.date.isoformat()])
+        return flask.jsonify(
+            steno_days=[row.date.isoformat() for row in days],
+            next=next_after)
+
+    (first_year, first_month) = steno_calendar_months[0]
+    (last_year, last_month) = steno_calendar_months[-1]
+    (_, last_month_days) = calendar.monthrange(last_year, last_month)
+    date_query = date_query.filter(Chapter.date.between(
+        date(first_year, first_month, 1),
+        date(last_year, last_month, last_month_days)))
+    steno_days = set(row.date for row in date_query)
     return flask.render_template('steno.html', **{
         'steno_days': steno_days,
+        'calendar_months': steno_calendar_months,
     })
 
 
 @pages.route('/person/')
 def person_index():
-    people = (models.Person.query
-                           .join(models.Mandate)
-                           .order_by('name'))
+    Person = models.Person
+    query = (models.db.session.query(Person.id, Person.name)
+                              .filter(Person.mandates.any()))
+    people, next_after = paginate(query,
+                                  [(Person.name, False), (Person.id, False)],
+                                  lambda row: [row.name, row.id])
+    people = [{'id': id, 'name': name} for (id, name) in people]
+    if wants_json():
+        return flask.jsonify(people=people, next=next_after)
     return flask.render_template('person_index.html', **{
         'people': people,
+        'next_after': next_after,
     })
 
 
 @pages.route('/person/<uuid:person_id>')
 def person(person_id):
     person = models.Person.query.get_or_404(person_id)
+    Mandate = models.Mandate
+    Stats = models.MandateStats
+    mandate_rows = (
+        models.db.session.query(
+            Mandate,
+            models.County.name,
+            models.Chamber.name,
+            Stats.question_count + Stats.interpelation_count,
+            Stats.paragraph_count,
+            Stats.sponsorship_count)
+        .join(Mandate.county)
+        .join(Mandate.chamber)
+        .outerjoin(Stats, Stats.id == Mandate.id)
+        .filter(Mandate.person_id == person.id)
+        .order_by(Mandate.year.desc())
+        .all())
+
+    # memberships for all mandates at once, with their group or committee
+    mandate_ids = [row[0].id for row in mandate_rows]
+    group_memberships = {}
+    committee_memberships = defaultdict(list)
+    if mandate_ids:
+        GroupMembership = models.MpGroupMembership
+        for membership in (GroupMembership.query
+                    .join(GroupMembership.mp_group)
+                    .options(contains_eager(GroupMembership.mp_group))
+                    .filter(GroupMembership.mandate_id.in_(mandate_ids))):
+            group_memberships.setdefault(membership.mandate_id, membership)
+
+        CommitteeMembership = models.MpCommitteeMembership
+        for membership in (CommitteeMembership.query
+                    .join(CommitteeMembership.mp_committee)
+                    .options(contains_eager(CommitteeMembership.mp_committee))
+                    .filter(CommitteeMembership.mandate_id.in_(mandate_ids))):
+            committee_memberships[membership.mandate_id].append(membership)
+
     mandates = [{
             'id': m.id,
             'cdep_url': m.get_cdep_url(),
             'year': m.year,
-            'county_name': m.county.name,
-            'chamber_name': m.chamber.name,
-            'questions_count': m.questions.count(),
-            'paragraphs_count': m.steno_paragraphs.count(),
-            'sponsorships_count': m.sponsorships.count(),
+            'county_name': county_name,
+            'chamber_name': chamber_name,
+            'questions_count': questions_count or 0,
+            'paragraphs_count': paragraphs_count or 0,
+            'sponsorships_count': sponsorships_count or 0,
             'college': m.college,
             'phone': m.phone,
             'address': m.address,
             'votes': m.votes,
             'votes_percent': m.votes_percent,
             'candidate_party': m.candidate_party,
-            'committee_memberships': (m.committee_memberships
-                                            .join(models.MpCommittee)
-                                            .all()),
-            'group_membership': (m.group_memberships
-                                        .join(models.MpGroup)
-                                        .first()),
-        } for m in person.mandates
-                         .join(models.Mandate.county)
-                         .join(models.Mandate.chamber)
-                         .order_by('-year')]
+            'committee_memberships': committee_memberships[m.id],
+            'group_membership': group_memberships.get(m.id),
+        } for (m, county_name, chamber_name, questions_count,
+               paragraphs_count, sponsorships_count) in mandate_rows]
     return flask.render_template('person.html', **{
         'person': person,
         'mandates': mandates,
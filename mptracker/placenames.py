@@ -88,9 +88,7 @@ def load_placenames():
         county['place_names'].update(
             siruta_loader.get_siruta_names(county['name']))
         county['place_names'] = sorted(county['place_names'])
-        out_name = '%02d.json' % county['code']
-        out_path = (path(flask.current_app.root_path) /
-                    'placename_data' / out_name)
+        out_path = county_data_path(county['code'])
         with out_path.open('w', encoding='utf-8') as f:
             flask.json.dump(county, f, indent=2, sort_keys=True)
             f.write('\n')
@@ -98,15 +96,35 @@ def load_placenames():
                     county['name'], county['code'], len(county['place_names']))
 
 
+def placename_data_path(json_name):
+    return path(flask.current_app.root_path) / 'placename_data' / json_name
+
+
+def county_data_path(code):
+    return placename_data_path('%02d.json' % code)
+
+
+def minority_data_path():
+    return placename_data_path('minority.json')
+
+
+def file_version(file_path):
+    """ Changes whenever the file is rewritten, e.g. by `load_placenames` """
+    stat = file_path.stat()
+    return (stat.st_mtime_ns, stat.st_size)
+
+
 @lru_cache(100)
-def get_county_data(code):
-    json_name = '%02d.json' % code
-    json_path = (path(flask.current_app.root_path) /
-                 'placename_data' / json_name)
+def load_json_version(json_path, version):
     with json_path.open('r', encoding='utf-8') as f:
         return flask.json.load(f)
 
 
+def get_county_data(code):
+    json_path = county_data_path(code)
+    return load_json_version(json_path, file_version(json_path))
+
+
 @placenames_manager.command
 def expand_minority_names():
     from mptracker.scraper.common import Scraper, get_cached_session, pqitems
@@ -126,9 +144,6 @@ def expand_minority_names():
     print(flask.json.dumps(doc, indent=2, sort_keys=True))
 
 
-@lru_cache()
 def get_minority_names():
-    json_path = (path(flask.current_app.root_path) /
-                 'placename_data' / 'minority.json')
-    with json_path.open('r', encoding='utf-8') as f:
-        return flask.json.load(f)
+    json_path = minority_data_path()
+    return load_json_version(json_path, file_version(json_path))
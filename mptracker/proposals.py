@@ -1,11 +1,10 @@
-from time import sleep
 import logging
 import flask
 from flask.ext.script import Manager
 from flask.ext.rq import job
 from mptracker import models
-from mptracker.common import ocr_url
-from mptracker.nlp import match_text_for_mandate
+from mptracker.common import ocr_url, MAX_OCR_PAGES, paginate, wants_json
+from mptracker.nlp import match_text_for_mandate, match_in_chunks, MatchJob
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -40,60 +39,75 @@ def proposal(proposal_id):
 
 @proposals.route('/proposals/relevant')
 def relevant():
-    sponsorships = [s for s in models.Sponsorship.query if s.match.score]
-    sponsorships.sort(key=lambda s: s.match.score or 0, reverse=True)
+    Sponsorship = models.Sponsorship
+    Match = models.Match
+    query = (models.db.session
+                .query(Sponsorship.id, models.Proposal.id,
+                       models.Proposal.title, models.Person.id,
+                       models.Person.name, Match.score)
+                .join(Sponsorship.proposal)
+                .join(Match, Match.id == Sponsorship.id)
+                .join(Sponsorship.mandate)
+                .join(models.Mandate.person)
+                .filter(Match.score > 0))
+    rows, next_after = paginate(query,
+                                [(Match.score, True), (Sponsorship.id, True)],
+                                lambda row: [row[5], row[0]])
+    sponsorships = [{
+            'id': id,
+            'proposal_id': proposal_id,
+            'proposal_title': proposal_title,
+            'person_id': person_id,
+            'person': person_name,
+            'score': score,
+        } for (id, proposal_id, proposal_title, person_id, person_name, score)
+          in rows]
+    if wants_json():
+        return flask.jsonify(sponsorships=sponsorships, next=next_after)
     return flask.render_template('proposals/relevant.html', **{
         'sponsorships': sponsorships,
+        'next_after': next_after,
     })
 
 
+@job
+def ocr_proposal(proposal_id, max_pages=MAX_OCR_PAGES):
+    proposal = models.Proposal.query.get(proposal_id)
+
+    result = ocr_url(proposal.pdf_url, max_pages=max_pages)
+    pages = result['pages']
+    proposal.text = '\n\n'.join(pages)
+
+    models.db.session.add(proposal)
+    models.db.session.commit()
+    logger.info("done OCR for %s (%d pages, timing %r)",
+                proposal_id, len(pages), result['timing'])
+
+
 @proposals_manager.command
-def ocr_all(number=None, force=False):
-    job_map = {}
+def ocr_all(number=None, force=False, max_pages=MAX_OCR_PAGES):
+    OcrText = models.OcrText
+    proposals_with_text = set(id for (id,) in (
+        models.db.session.query(OcrText.id)
+                         .filter(OcrText.parent == 'proposal')
+                         .filter(OcrText.text != None)))
 
     n_jobs = n_skip = n_ok = 0
-    for proposal in models.Proposal.query:
-        if not proposal.pdf_url:
+    proposal_rows = models.db.session.query(models.Proposal.id,
+                                            models.Proposal.pdf_url)
+    for (proposal_id, pdf_url) in proposal_rows:
+        if not pdf_url:
             n_skip += 1
             continue
-        if proposal.text is not None and not force:
+        if proposal_id in proposals_with_text and not force:
             n_ok += 1
             continue
-
-        job = ocr_url.delay(proposal.pdf_url)
-        job_map[proposal.id] = job
-
+        ocr_proposal.delay(proposal_id, int(max_pages))
         n_jobs += 1
         if number and n_jobs >= int(number):
             break
     logger.info("enqueued %d jobs, skipped %d, ok %d", n_jobs, n_skip, n_ok)
 
-    session = models.db.session
-
-    while job_map:
-        sleep(1)
-
-        done = set()
-        failed = set()
-        session.rollback()
-        for proposal_id, job in job_map.items():
-            if job.is_finished:
-                done.add(proposal_id)
-                proposal = models.Proposal.query.get(proposal_id)
-                pages = job.result
-                proposal.text = '\n\n'.join(pages)
-
-            elif job.is_failed:
-                failed.add(proposal_id)
-
-        session.commit()
-
-        if done or failed:
-            for proposal_id in done | failed:
-                del job_map[proposal_id]
-            logger.info("saved %d, failed %d, remaining %d",
-                        len(done), len(failed), len(job_map))
-
 
 @job
 @proposals_manager.command
@@ -107,26 +121,81 @@ def analyze_sponsorship(sponsorship_id):
     models.db.session.commit()
 
 
+def sponsorship_match_jobs(sponsorship_ids):
+    Sponsorship = models.Sponsorship
+    Proposal = models.Proposal
+    Mandate = models.Mandate
+    query = (models.db.session
+                .query(Sponsorship.id, Proposal.title, models.OcrText.text,
+                       models.Person.name, Mandate.minority,
+                       models.County.geonames_code)
+                .join(Proposal, Sponsorship.proposal_id == Proposal.id)
+                .join(models.OcrText, models.OcrText.id == Proposal.id)
+                .join(Mandate, Sponsorship.mandate_id == Mandate.id)
+                .join(models.Person, Mandate.person_id == models.Person.id)
+                .outerjoin(models.County,
+                           Mandate.county_id == models.County.id)
+                .filter(Sponsorship.id.in_(sponsorship_ids)))
+    for (id, title, text, person_name, minority, county_code) in query:
+        yield MatchJob(id, title + ' ' + text,
+                       person_name, minority, county_code)
+
+
 @proposals_manager.command
-def analyze_all(number=None, force=False, minority_only=False):
+def analyze_all(number=None, force=False, minority_only=False,
+                local=False, workers=None):
+    session = models.db.session
+    Sponsorship = models.Sponsorship
+    Mandate = models.Mandate
+    OcrText = models.OcrText
+    Match = models.Match
+
+    proposals_with_text = set(id for (id,) in (
+        session.query(OcrText.id)
+               .filter(OcrText.parent == 'proposal')
+               .filter(OcrText.text != None)))
+    match_row_ids = Match.all_ids_for('sponsorship')
+    analyzed_ids = set(id for (id,) in (
+        session.query(Match.id)
+               .filter(Match.parent == 'sponsorship')
+               .filter(Match.data != None)))
+
+    sponsorship_rows = (
+        session.query(Sponsorship.id, Sponsorship.proposal_id,
+                      Mandate.minority, models.County.geonames_code)
+               .join(Mandate, Sponsorship.mandate_id == Mandate.id)
+               .outerjoin(models.County,
+                          Mandate.county_id == models.County.id))
+
+    local_ids = []
     n_jobs = n_skip = n_ok = 0
-    for sponsorship in models.Sponsorship.query:
+    for (id, proposal_id, minority, county_code) in sponsorship_rows:
         if not force:
-            if sponsorship.match.data is not None:
+            if id in analyzed_ids:
                 n_ok += 1
                 continue
-        if sponsorship.proposal.text is None:
+        if proposal_id not in proposals_with_text:
             n_skip += 1
             continue
-        if not sponsorship.person.minority:
-            county = sponsorship.person.county
-            if (minority_only or
-                county is None or
-                county.geonames_code is None):
+        if not minority:
+            if minority_only or county_code is None:
                 n_skip += 1
                 continue
-        analyze_sponsorship.delay(sponsorship.id)
+        if local:
+            local_ids.append(id)
+        else:
+            analyze_sponsorship.delay(id)
         n_jobs += 1
         if number and n_jobs >= int(number):
             break
     logger.info("enqueued %d jobs, skipped %d, ok %d", n_jobs, n_skip, n_ok)
+
+    if local:
+        n_done = 0
+        for results in match_in_chunks(local_ids, sponsorship_match_jobs,
+                                       workers=workers and int(workers)):
+            Match.save_results('sponsorship', results, match_row_ids)
+            session.commit()
+            n_done += len(results)
+            logger.info("saved %d, remaining %d",
+                        n_done, len(local_ids) - n_done)
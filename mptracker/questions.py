@@ -4,8 +4,9 @@ import flask
 from flask.ext.script import Manager
 from flask.ext.rq import job
 from mptracker import models
-from mptracker.common import ocr_url, csv_lines
-from mptracker.nlp import match_text_for_mandate
+from mptracker.common import (ocr_url, csv_lines, MAX_OCR_PAGES,
+                              paginate, wants_json)
+from mptracker.nlp import match_text_for_mandate, match_in_chunks, MatchJob
 from mptracker.auth import require_privilege
 
 
@@ -18,19 +19,21 @@ questions_manager = Manager()
 
 
 @job
-def ocr_question(question_id):
+def ocr_question(question_id, max_pages=MAX_OCR_PAGES):
     question = models.Question.query.get(question_id)
 
-    pages = ocr_url(question.pdf_url)
+    result = ocr_url(question.pdf_url, max_pages=max_pages)
+    pages = result['pages']
     question.text = '\n\n'.join(pages)
 
     models.db.session.add(question)
     models.db.session.commit()
-    logger.info("done OCR for %s (%d pages)", question, len(pages))
+    logger.info("done OCR for %s (%d pages, timing %r)",
+                question, len(pages), result['timing'])
 
 
 @questions_manager.command
-def ocr_all(number=None, force=False):
+def ocr_all(number=None, force=False, max_pages=MAX_OCR_PAGES):
     text_row_ids = models.OcrText.all_ids_for('question')
     def has_text(question):
         return question.id in text_row_ids
@@ -44,7 +47,7 @@ def ocr_all(number=None, force=False):
         if has_text(question) and not force:
             n_ok += 1
             continue
-        ocr_question.delay(question.id)
+        ocr_question.delay(question.id, int(max_pages))
         n_jobs += 1
         if number and n_jobs >= int(number):
             break
@@ -59,66 +62,111 @@ def analyze_question(question_id):
     result = match_text_for_mandate(question.mandate, text)
     question.match.data = flask.json.dumps(result)
     question.match.score = len(result['top_matches'])
+    models.refresh_mandate_stats([question.mandate_id])
     models.db.session.commit()
 
 
+def question_match_jobs(question_ids):
+    Question = models.Question
+    Mandate = models.Mandate
+    query = (models.db.session
+                .query(Question.id, Question.title, models.OcrText.text,
+                       models.Person.name, Mandate.minority,
+                       models.County.geonames_code)
+                .join(models.OcrText, models.OcrText.id == Question.id)
+                .join(Mandate, Question.mandate_id == Mandate.id)
+                .join(models.Person, Mandate.person_id == models.Person.id)
+                .outerjoin(models.County,
+                           Mandate.county_id == models.County.id)
+                .filter(Question.id.in_(question_ids)))
+    for (id, title, text, person_name, minority, county_code) in query:
+        yield MatchJob(id, title + ' ' + text,
+                       person_name, minority, county_code)
+
+
 @questions_manager.command
-def analyze_all(number=None, force=False, minority_only=False):
-    text_row_ids = models.OcrText.all_ids_for('question')
-    def has_text(question):
-        return question.id in text_row_ids
+def analyze_all(number=None, force=False, minority_only=False,
+                local=False, workers=None):
+    Question = models.Question
+    Mandate = models.Mandate
 
+    text_row_ids = models.OcrText.all_ids_for('question')
     match_row_ids = models.Match.all_ids_for('question')
-    def has_match(question):
-        return question.id in match_row_ids
 
+    question_rows = (
+        models.db.session
+            .query(Question.id, Question.mandate_id,
+                   Mandate.minority, models.County.geonames_code)
+            .join(Mandate, Question.mandate_id == Mandate.id)
+            .outerjoin(models.County, Mandate.county_id == models.County.id))
+
+    local_ids = []
+    mandate_id_for_question = {}
     n_jobs = n_skip = n_ok = 0
-    for question in models.Question.query:
+    for (id, mandate_id, minority, county_code) in question_rows:
         if not force:
-            if has_match(question):
+            if id in match_row_ids:
                 n_ok += 1
                 continue
-        if not has_text(question):
+        if id not in text_row_ids:
             n_skip += 1
             continue
-        mandate = question.mandate
-        if not mandate.minority:
-            county = mandate.county
-            if (minority_only or
-                county is None or
-                county.geonames_code is None):
+        if not minority:
+            if minority_only or county_code is None:
                 n_skip += 1
                 continue
-        analyze_question.delay(question.id)
+        if local:
+            local_ids.append(id)
+            mandate_id_for_question[id] = mandate_id
+        else:
+            analyze_question.delay(id)
         n_jobs += 1
         if number and n_jobs >= int(number):
             break
     logger.info("enqueued %d jobs, skipped %d, ok %d", n_jobs, n_skip, n_ok)
 
+    if local:
+        n_done = 0
+        for results in match_in_chunks(local_ids, question_match_jobs,
+                                       workers=workers and int(workers)):
+            models.Match.save_results('question', results, match_row_ids)
+            models.refresh_mandate_stats(mandate_id_for_question[id]
+                                         for (id, _) in results)
+            models.db.session.commit()
+            n_done += len(results)
+            logger.info("saved %d, remaining %d",
+                        n_done, len(local_ids) - n_done)
+
 
 @questions.route('/questions/')
 def mandate_index():
-    from sqlalchemy import func
-    from sqlalchemy.orm import subqueryload
-    question_count_for_mandate = dict(
+    Mandate = models.Mandate
+    Stats = models.MandateStats
+    question_count = models.db.func.coalesce(
+        Stats.question_count + Stats.interpelation_count, 0)
+    query = (
         models.db.session
-            .query(models.Question.mandate_id,
-                   func.count(models.Question.mandate_id))
-            .group_by(models.Question.mandate_id)
-    )
-    mandate_rows = (models.Mandate.query
-                        .options(subqueryload(models.Mandate.county))
-                        .options(subqueryload(models.Mandate.person)))
+            .query(Mandate.id, models.Person.id, models.Person.name,
+                   models.County.name, question_count)
+            .join(Mandate.person)
+            .outerjoin(Stats, Stats.id == Mandate.id)
+            .outerjoin(Mandate.county))
+    mandate_rows, next_after = paginate(
+        query, [(question_count, True), (Mandate.id, False)],
+        lambda row: [row[4], row[0]])
     mandates = [{
-            'id': m.id,
-            'person_id': m.person.id,
-            'person': str(m.person),
-            'county_name': m.county.name if m.county else '',
-            'question_count': question_count_for_mandate.get(m.id, 0),
-        } for m in mandate_rows]
-    mandates.sort(key=lambda m: m['question_count'], reverse=True)
+            'id': id,
+            'person_id': person_id,
+            'person': person_name,
+            'county_name': county_name or '',
+            'question_count': question_count,
+        } for (id, person_id, person_name, county_name, question_count)
+          in mandate_rows]
+    if wants_json():
+        return flask.jsonify(mandates=mandates, next=next_after)
     return flask.render_template('questions/mandate_index.html', **{
         'mandates': mandates,
+        'next_after': next_after,
     })
 
 
@@ -1,4 +1,5 @@
 import logging
+from collections import Counter
 from flask.ext.script import Manager
 from mptracker.scraper.common import get_cached_session, create_session
 from mptracker import models
@@ -11,14 +12,21 @@ scraper_manager = Manager()
 
 
 @scraper_manager.command
-def questions(year='2013'):
+def questions(year='2013', workers='1', commit_every='100'):
+    """ Fetch new questions. Pages are fetched and parsed by `workers`
+    threads while the ones before them are matched to mandates and saved;
+    progress is committed every `commit_every` questions, and questions
+    already saved are skipped, so an interrupted run picks up where it
+    stopped. """
     from mptracker.scraper.questions import QuestionScraper
 
-    known_urls = set(q.url for q in models.Question.query)
+    known_urls = set(url for (url,) in
+                     models.db.session.query(models.Question.url))
     def skip_question(url):
         return url in known_urls
     questions_scraper = QuestionScraper(session=create_session(throttle=0.5),
-                                        skip=skip_question)
+                                        skip=skip_question,
+                                        workers=int(workers))
 
     mandate_lookup = models.MandateLookup()
 
@@ -26,12 +34,21 @@ def questions(year='2013'):
                                     models.db.session,
                                     key_columns=['number', 'date'])
 
-    with question_patcher.process() as add:
+    # mandates with questions in the batch that's not committed yet
+    mandate_ids = set()
+
+    def refresh_stats():
+        models.refresh_mandate_stats(mandate_ids)
+        mandate_ids.clear()
+
+    with question_patcher.process(commit_every=int(commit_every),
+                                  before_commit=refresh_stats) as add:
         for question in questions_scraper.run(int(year)):
             name, person_year, person_number = question.pop('person')
             mandate = mandate_lookup.find(name, person_year, person_number)
             question['mandate_id'] = mandate.id
             question['addressee'] = '; '.join(question['addressee'])
+            mandate_ids.add(mandate.id)
             add(question)
 
 
@@ -63,82 +80,107 @@ def people(year='2012'):
 
 
 @scraper_manager.command
-def committee_summaries(year=2013):
+def committee_summaries(year=2013, workers='1'):
     from mptracker.scraper.committee_summaries import SummaryScraper
 
     patcher = TablePatcher(models.CommitteeSummary,
                            models.db.session,
                            key_columns=['pdf_url'])
 
-    summary_scraper = SummaryScraper(get_cached_session(),
-                                     get_cached_session('question-pdf'))
+    summary_scraper = SummaryScraper(
+        create_session(cache_name='page-cache', throttle=0.5),
+        create_session(cache_name='question-pdf', throttle=0.5),
+        workers=int(workers))
     records = summary_scraper.fetch_summaries(year, get_pdf_text=True)
 
     patcher.update(records)
 
 
 @scraper_manager.command
-def proposals(dry_run=False):
+def proposals(dry_run=False, workers='1'):
     from mptracker.scraper.proposals import ProposalScraper
 
-    proposal_scraper = ProposalScraper(create_session(cache_name='page-cache',
-                                                      throttle=0.5))
+    session = models.db.session
+    Sponsorship = models.Sponsorship
+    Proposal = models.Proposal
 
-    def cdep_id(mandate):
-        return (mandate.year, mandate.cdep_number)
+    proposal_scraper = ProposalScraper(create_session(cache_name='page-cache',
+                                                      throttle=0.5),
+                                       workers=int(workers))
 
-    by_cdep_id = {cdep_id(m): m
-                  for m in models.Mandate.query
-                  if m.year == 2012}
+    mandate_id_by_cdep_id = {
+        (year, cdep_number): id
+        for (id, year, cdep_number) in
+        session.query(models.Mandate.id, models.Mandate.year,
+                      models.Mandate.cdep_number)
+               .filter(models.Mandate.year == 2012)
+    }
 
     chamber_by_slug = {c.slug: c for c in models.Chamber.query}
 
-    proposals = proposal_scraper.fetch_from_mp_pages(set(by_cdep_id.keys()))
+    # every (proposal, mandate) pair we have, loaded once
+    existing_sponsorships = {
+        (combined_id, mandate_id): sponsorship_id
+        for (sponsorship_id, combined_id, mandate_id) in
+        session.query(Sponsorship.id, Proposal.combined_id,
+                      Sponsorship.mandate_id)
+               .join(Proposal, Sponsorship.proposal_id == Proposal.id)
+    }
 
-    proposal_patcher = TablePatcher(models.Proposal,
-                                    models.db.session,
+    proposals = proposal_scraper.fetch_from_mp_pages(
+        set(mandate_id_by_cdep_id))
+
+    proposal_patcher = TablePatcher(Proposal, session,
                                     key_columns=['combined_id'])
 
-    sp_updates = sp_added = sp_removed = 0
+    new_sponsorships = set()
 
-    with proposal_patcher.process(autoflush=1000, remove=True) as add:
+    with proposal_patcher.process(autoflush=1000, remove=True,
+                                  dry_run=dry_run) as add:
         for record in proposals:
             if 'decision_chamber' in record:
                 slug = record.pop('decision_chamber')
                 record['decision_chamber'] = chamber_by_slug[slug]
 
-            sponsorships = record.pop('_sponsorships')
-            url = record['url']
-
-            result = add(record)
-            row = result.row
-
-            new_people = set(by_cdep_id[ci] for ci in sponsorships)
-            existing_sponsorships = {sp.mandate: sp for sp in row.sponsorships}
-            to_remove = set(existing_sponsorships) - set(new_people)
-            to_add = set(new_people) - set(existing_sponsorships)
-            if to_remove:
-                logger.info("Removing sponsors %s: %r", row.combined_id,
-                            [cdep_id(m) for m in to_remove])
-                sp_removed += 1
-                for m in to_remove:
-                    sp = existing_sponsorships[m]
-                    models.db.session.delete(sp)
-            if to_add:
-                logger.info("Adding sponsors %s: %r", row.combined_id,
-                            [cdep_id(m) for m in to_add])
-                sp_added += 1
-                for m in to_add:
-                    row.sponsorships.append(models.Sponsorship(mandate=m))
+            for ci in record.pop('_sponsorships'):
+                new_sponsorships.add((record['combined_id'],
+                                      mandate_id_by_cdep_id[ci]))
+
+            add(record)
+
+        to_remove = set(existing_sponsorships) - new_sponsorships
+        to_add = new_sponsorships - set(existing_sponsorships)
+        added = Counter(ci for (ci, _) in to_add)
+        removed = Counter(ci for (ci, _) in to_remove)
+        changed_proposals = sorted(set(added) | set(removed))
+        for combined_id in changed_proposals:
+            logger.info("Sponsors of %s: +%d, -%d", combined_id,
+                        added[combined_id], removed[combined_id])
 
-            if to_remove or to_add:
-                sp_updates += 1
+        if not dry_run:
+            removed_ids = [existing_sponsorships[pair] for pair in to_remove]
+            if removed_ids:
+                for table in [models.Match.__table__, Sponsorship.__table__]:
+                    session.execute(table.delete()
+                                         .where(table.c.id.in_(removed_ids)))
 
-        if dry_run:
-            models.db.session.rollback()
+            if to_add:
+                session.flush()  # new proposals get their ids
+                proposal_id_by_combined_id = dict(
+                    session.query(Proposal.combined_id, Proposal.id))
+                session.execute(Sponsorship.__table__.insert(), [
+                    {'id': models.random_uuid(),
+                     'proposal_id': proposal_id_by_combined_id[combined_id],
+                     'mandate_id': mandate_id}
+                    for (combined_id, mandate_id) in to_add
+                ])
+
+            models.refresh_mandate_stats(
+                mandate_id for (_, mandate_id) in to_add | to_remove)
 
-    logger.info("Updated sponsorship for %d proposals (+%d, -%d)",
-                sp_updates, sp_added, sp_removed)
+    logger.info("%s sponsorship for %d proposals (+%d, -%d)",
+                "Would update" if dry_run else "Updated",
+                len(changed_proposals), len(to_add), len(to_remove))
 
 
 @scraper_manager.command
@@ -165,14 +207,14 @@ def import_person_xls(xls_path):
             people_data.append(person_data)
             mandate_committees = record.pop('committees')
             mp_group = record.pop('mp_group')
-            mandate = add(record).row
+            mandate_id = add(record).id
             for data in mandate_committees:
                 committees[data['name']] = None
                 committee_memberships.append(
-                    (mandate.id, data['name'], data['role']))
+                    (mandate_id, data['name'], data['role']))
             groups[mp_group['short_name']] = None
             group_memberships.append(
-                    (mandate.id, mp_group['short_name'], mp_group['role']))
+                    (mandate_id, mp_group['short_name'], mp_group['role']))
 
     person_patcher = TablePatcher(models.Person,
                                   models.db.session,
@@ -186,8 +228,7 @@ def import_person_xls(xls_path):
                                      key_columns=['name'])
     with committee_patcher.process() as add:
         for name in list(committees):
-            mp_committee = add({'name': name}).row
-            committees[name] = mp_committee.id
+            committees[name] = add({'name': name}).id
 
     committee_membership_patcher = TablePatcher(models.MpCommitteeMembership,
             models.db.session, key_columns=['mandate_id', 'mp_committee_id'])
@@ -204,8 +245,7 @@ def import_person_xls(xls_path):
                                     key_columns=['short_name'])
     with mp_group_patcher.process() as add:
         for short_name in list(groups):
-            mp_group = add({'short_name': short_name}).row
-            groups[short_name] = mp_group.id
+            groups[short_name] = add({'short_name': short_name}).id
 
     mp_group_membership_patcher = TablePatcher(models.MpGroupMembership,
             models.db.session, key_columns=['mandate_id', 'mp_group_id'])
@@ -216,3 +256,60 @@ def import_person_xls(xls_path):
                 'mp_group_id': groups[name],
                 'role': role,
             })
+
+
+def iter_http_caches(name=None):
+    from mptracker.scraper.common import project_root, cache_db_path
+    from mptracker.scraper.httpcache import get_cache
+    if name is None:
+        suffix = '.cache.sqlite'
+        names = sorted(p.name[:-len(suffix)] for p in
+                       (project_root / '_data').files('*' + suffix))
+    else:
+        names = [name]
+    for cache_name in names:
+        yield cache_name, get_cache(cache_db_path(cache_name))
+
+
+def format_size(n_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n_bytes < 1024 or unit == 'GB':
+            return '%.1f %s' % (n_bytes, unit)
+        n_bytes /= 1024
+
+
+@scraper_manager.command
+def cache_info(name=None):
+    """ Report the size of HTTP caches """
+    for cache_name, cache in iter_http_caches(name):
+        stats = cache.stats()
+        print("{name}: {responses} responses ({stale} stale), "
+              "{content} of content, {file} on disk".format(
+                  name=cache_name,
+                  responses=stats['responses'],
+                  stale=stats['stale'],
+                  content=format_size(stats['content_size']),
+                  file=format_size(stats['file_size'])))
+
+
+@scraper_manager.command
+def cache_compact(name=None, stale_days=None):
+    """ Reclaim free space in HTTP caches; with `--stale_days`, first drop
+    responses that expired that many days ago. """
+    stale_for = None if stale_days is None else float(stale_days) * 86400
+    for cache_name, cache in iter_http_caches(name):
+        before = cache.stats()['file_size']
+        removed = cache.compact(stale_for)
+        after = cache.stats()['file_size']
+        logger.info("%s: removed %d responses, %s -> %s", cache_name,
+                    removed, format_size(before), format_size(after))
+
+
+@scraper_manager.command
+def cache_import(name):
+    """ Import a cache written by requests_cache, `_data/<name>.sqlite` """
+    from mptracker.scraper.common import project_root
+    [(cache_name, cache)] = iter_http_caches(name)
+    imported = cache.import_requests_cache(
+        project_root / '_data' / (name + '.sqlite'))
+    logger.info("%s: imported %d responses", cache_name, imported)
@@ -1,36 +1,32 @@
 import re
 from datetime import datetime
-import subprocess
 from urllib.parse import urlparse, parse_qs
 from pyquery import PyQuery as pq
 from flask import json
 from path import path
 from mptracker.scraper.common import (Scraper, pqitems, get_cached_session)
+from mptracker.common import pdf_to_text
 
 
 with (path(__file__).parent / 'committee_names.json').open('rb') as f:
     committee_names = json.loads(f.read().decode('utf-8'))
 
 
-def pdf_to_text(pdf_bytes):
-    """ run pdftotext from poppler """
-    p = subprocess.Popen(['pdftotext', '-enc', 'UTF-8', '-', '-'],
-                         stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE)
-    outs, errs = p.communicate(pdf_bytes, timeout=10)
-    return outs.decode('utf-8')
-
-
 class SummaryScraper(Scraper):
 
     listing_page_url = ('http://www.cdep.ro/pls/proiecte/upl_com.lista'
                         '?nrc={offset}&an={year}&tip=1&sz=1')
     pdf_url_pattern = re.compile(r'cdep\.ro/comisii/(?P<committee>[^/]+)/pdf/')
 
-    def __init__(self, session=None, pdf_session=None):
-        super().__init__(session)
+    def __init__(self, session=None, pdf_session=None, workers=1):
+        super().__init__(session, workers=workers)
         self.pdf_session = pdf_session or self.session
 
+    def add_pdf_text(self, row):
+        pdf_data = self.pdf_session.get(row['pdf_url']).content
+        row['text'] = pdf_to_text(pdf_data)
+        return row
+
     def fetch_summaries(self, year=2013, get_pdf_text=False):
         from collections import defaultdict
         for p in range(50):
@@ -39,7 +35,8 @@ class SummaryScraper(Scraper):
             i_el = list(pqitems(page, ":contains('înregistrări')"))[-1]
             table = list(i_el.parents('table'))[-1]
             empty_page = True
-            table_rows = pqitems(pq(table), 'tr')
+            page_rows = []
+            table_rows = iter(pqitems(pq(table), 'tr'))
             assert "înregistrări găsite:" in next(table_rows).text()
             assert next(table_rows).text() == "Nr. Crt. PDF Data Titlu Comisia"
             for tr in table_rows:
@@ -55,19 +52,17 @@ class SummaryScraper(Scraper):
                 assert pdf_url_m is not None, "can't parse url: %r" % pdf_url
                 committee_code = pdf_url_m.group('committee')
                 assert committee_names[committee_code] == col5.text()
-                row = {
+                page_rows.append({
                     'committee': committee_code,
                     'pdf_url': pdf_url,
                     'date': date_value,
                     'title': title,
-                }
-
-                if get_pdf_text:
-                    pdf_data = self.pdf_session.get(pdf_url).content
-                    text = pdf_to_text(pdf_data)
-                    row['text'] = text
+                })
 
-                yield row
+            if get_pdf_text:
+                yield from self.map(self.add_pdf_text, page_rows)
+            else:
+                yield from page_rows
 
             if empty_page:
                 break
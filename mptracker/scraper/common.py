@@ -1,26 +1,41 @@
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode, urlparse, parse_qs
 from path import path
 import requests
 from pyquery import PyQuery as pq
+import lxml.html
 
 
 project_root = path(__file__).abspath().parent.parent.parent
 
+# pyquery's `make_links_absolute` passes each link to its callback through
+# a module global, so threads must take turns
+make_links_absolute_lock = threading.Lock()
+
+cdep_html_parser = lxml.html.HTMLParser(encoding='iso-8859-2')
+
 
 class Scraper(object):
 
-    def __init__(self, session=None, use_cdep_opener=True):
+    def __init__(self, session=None, use_cdep_opener=True, workers=1):
         self.session = session or requests.Session()
         self.use_cdep_opener = use_cdep_opener
+        self.workers = workers
 
-    def fetch_url(self, url, args=None):
+    def build_url(self, url, args=None):
         if args:
             if '?' not in url:
                 url += '?'
             elif url[-1] not in ['?', '&']:
                 url += '&'
             url += urlencode(args)
+        return url
+
+    def fetch_url(self, url, args=None):
+        url = self.build_url(url, args)
         kwargs = {'parser': 'html'}
         if self.use_cdep_opener:
             def opener(url):
@@ -30,30 +45,103 @@ class Scraper(object):
                 return text.encode('utf-16')
             kwargs['opener'] = opener
         page = pq(url, **kwargs)
-        page.make_links_absolute()
+        with make_links_absolute_lock:
+            page.make_links_absolute()
         return page
 
+    def fetch_html(self, url, args=None):
+        """ Fetch a cdep page as a bare lxml tree, parsed straight from the
+        response bytes; cheaper than `fetch_url` for pages that are walked
+        with XPath. Links are left as they are. """
+        url = self.build_url(url, args)
+        resp = self.session.get(url)
+        return lxml.html.document_fromstring(resp.content,
+                                             parser=cdep_html_parser)
+
+    def map(self, func, items):
+        """ Like the builtin `map`, but run `func` in `self.workers` threads.
+        Results come out in order, and only a few items are processed ahead
+        of the consumer; requests are rate-limited by the session's throttle,
+        which is shared between threads. """
+        if self.workers <= 1:
+            yield from map(func, items)
+            return
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = deque()
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+class TokenBucket:
+    """ Allow `rate` events per second, in bursts of up to `capacity` """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+host_buckets = {}
+host_buckets_lock = threading.Lock()
+
+
+def get_host_bucket(host, seconds):
+    with host_buckets_lock:
+        if (host, seconds) not in host_buckets:
+            host_buckets[host, seconds] = TokenBucket(1 / seconds)
+        return host_buckets[host, seconds]
+
+
+def throttle_session(session, seconds):
+    """ Make `session` take a token from the host's bucket before each
+    request goes out, so requests to a host start at least `seconds` apart,
+    whichever thread sends them. Cached responses are not sent, so they are
+    not throttled. """
+    send = session.send
+
+    def throttled_send(request, **kwargs):
+        host = urlparse(request.url).netloc
+        get_host_bucket(host, seconds).acquire()
+        return send(request, **kwargs)
+
+    session.send = throttled_send
+    return session
+
 
-def create_throttle(seconds):
-    def hook(response, **extra):
-        if not getattr(response, 'from_cache', False):
-            # logger.debug("Throttle: %s", seconds)
-            time.sleep(seconds)
-        return response
-    return hook
+def cache_db_path(cache_name):
+    return project_root / '_data' / (cache_name + '.cache.sqlite')
 
 
 def create_session(cache_name=None, throttle=None):
     if cache_name:
-        import requests_cache
-        cache_path = project_root / '_data' / cache_name
-        session = requests_cache.CachedSession(cache_path)
+        from mptracker.scraper.httpcache import CachedSession, get_cache
+        session = CachedSession(get_cache(cache_db_path(cache_name)))
 
     else:
         session = requests.Session()
 
     if throttle:
-        session.hooks = {'response': create_throttle(throttle)}
+        throttle_session(session, throttle)
 
     return session
 
@@ -0,0 +1,213 @@
+""" HTTP cache for scraper sessions, kept in an SQLite file in WAL mode.
+
+Each URL has at most one cached response. Listing pages expire after a
+while and are then revalidated with a conditional request; everything else
+(detail pages, PDFs) is kept until the cache is compacted.
+"""
+
+import re
+import time
+import calendar
+import json
+import pickle
+import sqlite3
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+# (url pattern, seconds before the cached page is revalidated); the first
+# matching pattern wins, and urls that match nothing never expire
+ttl_policies = [
+    (r'/pls/steno/steno\.data\?', DAY),
+    (r'/pls/parlam/interpelari\.lista\?', DAY),
+    (r'/pls/proiecte/upl_com\.lista\?', DAY),
+    (r'/pls/parlam/structura\.mp\?.*pag=2', DAY),
+    (r'/pls/parlam/structura\.de\?', 7 * DAY),
+]
+
+
+def url_ttl(url, policies=ttl_policies):
+    for pattern, ttl in policies:
+        if re.search(pattern, url):
+            return ttl
+    return None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS response (
+    url TEXT PRIMARY KEY,
+    status_code INTEGER,
+    headers TEXT,
+    content BLOB,
+    etag TEXT,
+    last_modified TEXT,
+    fetched REAL,
+    expires REAL
+)
+"""
+
+
+class HttpCache:
+    """ Responses keyed by url. Each thread gets its own connection; WAL
+    mode lets them read while another one writes. """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_path, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute(SCHEMA)
+            self.local.db = db
+        return db
+
+    def get(self, url):
+        row = self.db.execute(
+            'SELECT status_code, headers, content, etag, last_modified, '
+            'expires FROM response WHERE url = ?', [url]).fetchone()
+        if row is None:
+            return None
+        keys = ['status_code', 'headers', 'content', 'etag',
+                'last_modified', 'expires']
+        return dict(zip(keys, row))
+
+    def put(self, url, status_code, headers, content, expires):
+        headers = CaseInsensitiveDict(headers)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO response VALUES (?,?,?,?,?,?,?,?)',
+                [url, status_code, json.dumps(dict(headers)),
+                 content, headers.get('ETag'), headers.get('Last-Modified'),
+                 time.time(), expires])
+
+    def touch(self, url, expires):
+        with self.db:
+            self.db.execute(
+                'UPDATE response SET fetched = ?, expires = ? WHERE url = ?',
+                [time.time(), expires, url])
+
+    def stats(self):
+        (count, content_size, stale) = self.db.execute(
+            'SELECT count(*), coalesce(sum(length(content)), 0), '
+            'coalesce(sum(expires < ?), 0) FROM response',
+            [time.time()]).fetchone()
+        (page_count,) = self.db.execute('PRAGMA page_count').fetchone()
+        (page_size,) = self.db.execute('PRAGMA page_size').fetchone()
+        return {
+            'responses': count,
+            'stale': stale,
+            'content_size': content_size,
+            'file_size': page_count * page_size,
+        }
+
+    def compact(self, stale_for=None):
+        """ Drop responses that expired more than `stale_for` seconds ago,
+        if given, then give the free space back to the filesystem. """
+        removed = 0
+        if stale_for is not None:
+            with self.db:
+                cursor = self.db.execute(
+                    'DELETE FROM response WHERE expires < ?',
+                    [time.time() - stale_for])
+                removed = cursor.rowcount
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.db.execute('VACUUM')
+        return removed
+
+    def import_requests_cache(self, legacy_path, policies=ttl_policies):
+        """ Copy the responses stored by `requests_cache`'s sqlite backend,
+        so switching caches doesn't mean downloading everything again. """
+        legacy = sqlite3.connect(str(legacy_path))
+        imported = 0
+        for (value,) in legacy.execute('SELECT value FROM responses'):
+            try:
+                (stored, created) = pickle.loads(bytes(value))
+            except Exception:
+                continue
+            url = getattr(stored, 'url', None)
+            content = getattr(stored, '_content', None)
+            if (url is None or content is None or
+                    getattr(stored, 'status_code', None) != 200):
+                continue
+            if self.get(url) is not None:
+                continue
+            ttl = url_ttl(url, policies)
+            # requests_cache recorded `datetime.utcnow()`
+            fetched = (calendar.timegm(created.utctimetuple())
+                       if created else time.time())
+            expires = None if ttl is None else fetched + ttl
+            self.put(url, 200, getattr(stored, 'headers', {}),
+                     content, expires)
+            imported += 1
+        return imported
+
+
+class CachedSession(requests.Session):
+    """ A session that answers GET requests from an `HttpCache`. Responses
+    served from the cache have `from_cache` set; they are never sent, so
+    they are not throttled. """
+
+    def __init__(self, cache, policies=ttl_policies):
+        super().__init__()
+        self.cache = cache
+        self.policies = policies
+
+    def cached_response(self, url, cached):
+        response = requests.Response()
+        response.url = url
+        response.status_code = cached['status_code']
+        response.headers = CaseInsensitiveDict(json.loads(cached['headers']))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = cached['content']
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if method.upper() != 'GET' or params:
+            return super().request(method, url, params=params,
+                                   headers=headers, **kwargs)
+
+        now = time.time()
+        cached = self.cache.get(url)
+        if cached is not None:
+            if cached['expires'] is None or cached['expires'] > now:
+                return self.cached_response(url, cached)
+            headers = dict(headers or {})
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = super().request(method, url, headers=headers, **kwargs)
+        response.from_cache = False
+        ttl = url_ttl(url, self.policies)
+        expires = None if ttl is None else now + ttl
+        if cached is not None and response.status_code == 304:
+            self.cache.touch(url, expires)
+            return self.cached_response(url, cached)
+        if response.status_code == 200:
+            self.cache.put(url, 200, response.headers, response.content,
+                           expires)
+        return response
+
+
+caches = {}
+caches_lock = threading.Lock()
+
+
+def get_cache(db_path):
+    """ One `HttpCache` per file, shared by the sessions that use it """
+    with caches_lock:
+        if db_path not in caches:
+            caches[db_path] = HttpCache(db_path)
+        return caches[db_path]
@@ -1,5 +1,6 @@
 import re
 import logging
+from collections import defaultdict
 from pyquery import PyQuery as pq
 from mptracker.scraper.common import Scraper, pqitems, get_cdep_id
 from mptracker.common import fix_local_chars
@@ -18,21 +19,33 @@ class ProposalScraper(Scraper):
         return fix_local_chars(re.sub(r'[\s\-]+', ' ', name))
 
     def fetch_from_mp_pages(self, mandate_cdep_id_list):
-        proposals = {}
-        for mandate_cdep_id in mandate_cdep_id_list:
-            for combined_id, proposal_url in \
-                    self.fetch_mp_proposals(mandate_cdep_id):
-                if combined_id in proposals:
-                    proposal_data = proposals[combined_id]
-                    assert proposal_data['url'] == proposal_url
+        """ Fetch all MP proposal lists, then the details of each distinct
+        proposal, once; records are yielded as their details come in. """
+        mandate_cdep_id_list = list(mandate_cdep_id_list)
+        mp_proposals = self.map(lambda ci: list(self.fetch_mp_proposals(ci)),
+                                mandate_cdep_id_list)
+        proposal_urls = {}
+        sponsorships = defaultdict(list)
+        for mandate_cdep_id, mp_proposal_list in \
+                zip(mandate_cdep_id_list, mp_proposals):
+            for combined_id, proposal_url in mp_proposal_list:
+                if combined_id in proposal_urls:
+                    assert proposal_urls[combined_id] == proposal_url
                 else:
-                    proposal_data = self.fetch_proposal_details(proposal_url)
-                    assert proposal_data['url'] == proposal_url
-                    proposal_data['combined_id'] = combined_id
-                    proposal_data['_sponsorships'] = []
-                    proposals[combined_id] = proposal_data
-                proposal_data['_sponsorships'].append(mandate_cdep_id)
-        return list(proposals.values())
+                    proposal_urls[combined_id] = proposal_url
+                sponsorships[combined_id].append(mandate_cdep_id)
+
+        logger.info("Fetching details for %d proposals", len(proposal_urls))
+
+        def fetch_details(combined_id):
+            proposal_data = self.fetch_proposal_details(
+                proposal_urls[combined_id])
+            assert proposal_data['url'] == proposal_urls[combined_id]
+            proposal_data['combined_id'] = combined_id
+            proposal_data['_sponsorships'] = sponsorships[combined_id]
+            return proposal_data
+
+        yield from self.map(fetch_details, list(proposal_urls))
 
     def fetch_mp_proposals(self, cdep_id):
         (leg, idm) = cdep_id
@@ -111,6 +111,7 @@ class QuestionScraper(Scraper):
         index = self.fetch_url('http://www.cdep.ro/pls/parlam/'
                                'interpelari.lista?tip=&dat={year}&idl=1'
                                .format(year=year))
+        hrefs = []
         for link in pqitems(index, '#pageContent table a'):
             href = link.attr('href')
             if href in url_skip:
@@ -121,4 +122,6 @@ class QuestionScraper(Scraper):
             if self.skip(href):
                 logger.debug('skipping %r', href)
             else:
-                yield self.get_question(href)
+                hrefs.append(href)
+
+        yield from self.map(self.get_question, hrefs)
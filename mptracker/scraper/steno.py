@@ -1,10 +1,24 @@
 """ Fetch and parse stenograms """
 
 from datetime import date
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 from pyquery import PyQuery as pq
-from mptracker.scraper.common import (Scraper, pqitems, get_cached_session,
-                                      get_cdep_id)
+from lxml import etree
+from mptracker.scraper.common import Scraper, get_cached_session, get_cdep_id
+
+
+steno_paragraphs_xpath = etree.XPath(
+    '//*[@id="pageContent"]/table//tr//td//p')
+speaker_xpath = etree.XPath('.//b//font[@color="#0000FF"]')
+speaker_link_xpath = etree.XPath('ancestor::a/@href', smart_strings=False)
+text_xpath = etree.XPath('.//text()', smart_strings=False)
+
+
+def element_text(el):
+    """ Text of an element and its children, like `PyQuery.text()` """
+    return ' '.join(t.strip() for t in text_xpath(el) if t.strip())
 
 
 class StenoDay:
@@ -44,12 +58,8 @@ class StenogramScraper(Scraper):
             headline = pq(headline_el).text()
             yield link, headline
 
-    def get_chapter_serial(self):
-        return self.day.strftime('%Y-%m-%d') + '/%02d' % self.chapter_serial
-
-    def next_paragraph_serial(self):
-        self.paragraph_serial += 1
-        return self.get_chapter_serial() + '-%03d' % self.paragraph_serial
+    def get_chapter_serial(self, day, number):
+        return day.strftime('%Y-%m-%d') + '/%02d' % number
 
     def trim_name(self, name):
         for prefix in ['Domnul ', 'Doamna ', 'Domnişoara ']:
@@ -58,64 +68,115 @@ class StenogramScraper(Scraper):
         else:
             return name
 
-    def parse_steno_page(self, link):
-        page = self.fetch_url(link)
-        table_rows = pqitems(page, '#pageContent > table tr')
+    def iter_paragraphs(self, page, chapter_serial):
+        """ Walk the page's paragraphs in a single pass, yielding each
+        speaker's text as soon as the next speaker shows up. """
         steno_paragraph = None
-        steno_chapter = StenoChapter()
-        text_buffer = []
+        paragraph_count = 0
 
-        def save_paragraph():
+        def finish_paragraph():
             text = "\n".join(steno_paragraph.pop('text_buffer'))
             steno_paragraph['text'] = text
-            steno_chapter.paragraphs.append(steno_paragraph)
-
-        for tr in table_rows:
-            for td in pqitems(tr, 'td'):
-                for paragraph in pqitems(td, 'p'):
-                    speakers = paragraph('b font[color="#0000FF"]')
-                    if speakers:
-                        if steno_paragraph:
-                            save_paragraph()
-                        assert len(speakers) == 1
-                        speaker_name = self.trim_name(speakers.text())
-                        link = speakers.parents('a')
-                        if link:
-                            speaker_cdep_id = get_cdep_id(link.attr('href'))
-                        else:
-                            speaker_cdep_id = None
-                        steno_paragraph = StenoParagraph({
-                            'speaker_cdep_id': speaker_cdep_id,
-                            'speaker_name': speaker_name,
-                            'text_buffer': [],
-                            'serial': self.next_paragraph_serial()
-                        })
-
-                    else:
-                        if steno_paragraph is None:
-                            continue  # still looking for first speaker
-                        text = paragraph.text()
-                        steno_paragraph['text_buffer'].append(text)
+            return steno_paragraph
+
+        for paragraph in steno_paragraphs_xpath(page):
+            speakers = speaker_xpath(paragraph)
+            if speakers:
+                if steno_paragraph:
+                    yield finish_paragraph()
+                assert len(speakers) == 1
+                speaker_name = self.trim_name(element_text(speakers[0]))
+                link = speaker_link_xpath(speakers[0])
+                if link:
+                    speaker_cdep_id = get_cdep_id(link[0])
+                else:
+                    speaker_cdep_id = None
+                paragraph_count += 1
+                steno_paragraph = StenoParagraph({
+                    'speaker_cdep_id': speaker_cdep_id,
+                    'speaker_name': speaker_name,
+                    'text_buffer': [],
+                    'serial': chapter_serial + '-%03d' % paragraph_count,
+                })
+
+            else:
+                if steno_paragraph is None:
+                    continue  # still looking for first speaker
+                steno_paragraph['text_buffer'].append(element_text(paragraph))
 
         if steno_paragraph:
-            save_paragraph()
+            yield finish_paragraph()
 
+    def parse_steno_page(self, link, chapter_serial):
+        page = self.fetch_html(link)
+        steno_chapter = StenoChapter()
+        steno_chapter.paragraphs = list(self.iter_paragraphs(page,
+                                                             chapter_serial))
         return steno_chapter
 
-    def fetch_day(self, day):
-        self.day = day
-        self.chapter_serial = 0
+    def chapter_links(self, day, skip_serials=()):
+        """ Numbered links to the day's chapters, except for those in
+        `skip_serials` """
+        return [
+            (number, chapter_link) for number, chapter_link
+            in enumerate(self.chapters_for_day(day), 1)
+            if self.get_chapter_serial(day, number) not in skip_serials
+        ]
+
+    def fetch_chapter(self, day, numbered_link):
+        (number, (link, headline)) = numbered_link
+        serial = self.get_chapter_serial(day, number)
+        steno_chapter = self.parse_steno_page(link, serial)
+        steno_chapter.headline = headline
+        steno_chapter.serial = serial
+        return steno_chapter
+
+    def fetch_day(self, day, skip_serials=()):
+        """ Fetch the day's chapters, except for those in `skip_serials`,
+        which costs just a request for the day's table of contents if all
+        chapters are skipped. """
         steno_day = StenoDay()
         steno_day.date = day
-        for link, headline in self.chapters_for_day(day):
-            self.chapter_serial += 1
-            self.paragraph_serial = 0
-            steno_chapter = self.parse_steno_page(link)
-            steno_chapter.headline = headline
-            steno_chapter.serial = self.get_chapter_serial()
-            steno_day.chapters.append(steno_chapter)
+        steno_day.chapters = list(self.map(
+            lambda numbered_link: self.fetch_chapter(day, numbered_link),
+            self.chapter_links(day, skip_serials)))
         return steno_day
 
+    def fetch_days(self, days, skip_serials_for_day):
+        """ Fetch several days like `fetch_day`, and yield `(day, steno_day,
+        error)` in order. Tables of contents and chapters are all fetched by
+        one pool of `self.workers` threads, so no more requests than that
+        are in flight; the next days' tables of contents are fetched along
+        with the current day's chapters. """
+        days = iter(days)
+        with ThreadPoolExecutor(max(self.workers, 1)) as executor:
+            contents = deque()
+
+            def fetch_next_contents():
+                for day in days:
+                    contents.append((day, executor.submit(
+                        self.chapter_links, day, skip_serials_for_day(day))))
+                    return
+
+            for n in range(max(self.workers, 1)):
+                fetch_next_contents()
+
+            while contents:
+                (day, links_future) = contents.popleft()
+                fetch_next_contents()
+                try:
+                    chapter_futures = [
+                        executor.submit(self.fetch_chapter, day, numbered_link)
+                        for numbered_link in links_future.result()]
+                    steno_day = StenoDay()
+                    steno_day.date = day
+                    steno_day.chapters = [future.result()
+                                          for future in chapter_futures]
+                except Exception as e:
+                    yield day, None, e
+                else:
+                    yield day, steno_day, None
+
 
 if __name__ == '__main__':
     steno_scraper = StenogramScraper(get_cached_session())
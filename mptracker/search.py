@@ -0,0 +1,238 @@
+""" Full-text search over stenograms, OCR'd texts and committee summaries """
+
+import logging
+import flask
+from flask.ext.script import Manager
+from sqlalchemy import event, func
+from sqlalchemy.orm.attributes import get_history
+from mptracker import models
+from mptracker.nlp import normalize
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+search = flask.Blueprint('search', __name__)
+
+search_manager = Manager()
+
+SEARCH_CONFIG = 'simple'
+PAGE_SIZE = 20
+SNIPPET_LENGTH = 300
+
+
+# (model, parent name or None to use `row.parent`, text columns)
+indexed_models = [
+    (models.StenoParagraph, 'steno_paragraph', ['text']),
+    (models.OcrText, None, ['text']),
+    (models.CommitteeSummary, 'committee_summary', ['title', 'text']),
+]
+
+
+def document_text(row, text_columns):
+    return '\n'.join(getattr(row, col) or '' for col in text_columns)
+
+
+def search_vector(text):
+    # diacritics are folded in python, the same way `match_names` does it
+    return func.to_tsvector(SEARCH_CONFIG, normalize(text))
+
+
+def index_document(connection, id, parent, text):
+    table = models.SearchDocument.__table__
+    connection.execute(table.delete().where(table.c.id == id))
+    if text.strip():
+        connection.execute(table.insert().values(id=id, parent=parent,
+                                                 vector=search_vector(text)))
+
+
+def index_documents(connection, documents):
+    """ Bulk-insert `(id, parent, text)` documents; for writes that bypass
+    the ORM, and therefore the index hooks. """
+    insert = models.SearchDocument.__table__.insert().values(
+        vector=func.to_tsvector(SEARCH_CONFIG,
+                                models.db.bindparam('normalized')))
+    batch = [{'id': id, 'parent': parent, 'normalized': normalize(text)}
+             for (id, parent, text) in documents if text and text.strip()]
+    if batch:
+        connection.execute(insert, batch)
+    return len(batch)
+
+
+def register_index_hooks(model, parent, text_columns):
+    def get_parent(row):
+        return parent or row.parent
+
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, row):
+        index_document(connection, row.id, get_parent(row),
+                       document_text(row, text_columns))
+
+    @event.listens_for(model, 'after_update')
+    def after_update(mapper, connection, row):
+        if any(get_history(row, col).has_changes() for col in text_columns):
+            index_document(connection, row.id, get_parent(row),
+                           document_text(row, text_columns))
+
+    @event.listens_for(model, 'after_delete')
+    def after_delete(mapper, connection, row):
+        table = models.SearchDocument.__table__
+        connection.execute(table.delete().where(table.c.id == row.id))
+
+
+for model, parent, text_columns in indexed_models:
+    register_index_hooks(model, parent, text_columns)
+
+
+@search_manager.command
+def reindex(parent=None, batch_size=1000):
+    """ Rebuild the index; the scrapers and OCR jobs keep it up to date. """
+    session = models.db.session
+    table = models.SearchDocument.__table__
+    batch_size = int(batch_size)
+
+    if parent is None:
+        session.execute(table.delete())
+    else:
+        session.execute(table.delete().where(table.c.parent == parent))
+
+    for model, model_parent, text_columns in indexed_models:
+        if model_parent is None:
+            parent_column = model.parent
+        else:
+            if parent is not None and parent != model_parent:
+                continue
+            parent_column = models.db.literal(model_parent)
+        query = session.query(model.id, parent_column,
+                              *[getattr(model, col) for col in text_columns])
+        if parent is not None and model_parent is None:
+            query = query.filter(model.parent == parent)
+
+        n_indexed = 0
+        batch = []
+        def flush_batch():
+            nonlocal n_indexed
+            n_indexed += index_documents(session, batch)
+            del batch[:]
+
+        rows = (query.execution_options(stream_results=True)
+                     .yield_per(batch_size))
+        for row in rows:
+            batch.append((row[0], row[1],
+                          '\n'.join(value or '' for value in row[2:])))
+            if len(batch) >= batch_size:
+                flush_batch()
+        flush_batch()
+        session.commit()
+        logger.info("Indexed %d %s rows", n_indexed, model.__name__)
+
+
+def snippet(text, words):
+    norm_text = normalize(text)
+    positions = [norm_text.find(w) for w in words if w in norm_text]
+    start = max(0, min(positions) - SNIPPET_LENGTH // 3) if positions else 0
+    fragment = text[start : start + SNIPPET_LENGTH].strip()
+    return ('…' if start > 0 else '') + fragment
+
+
+def describe_results(ids_by_parent):
+    """ Title, link and text for each result, keyed by id """
+    session = models.db.session
+    out = {}
+
+    ids = ids_by_parent.get('steno_paragraph')
+    if ids:
+        Paragraph = models.StenoParagraph
+        Chapter = models.StenoChapter
+        query = (session.query(Paragraph.id, Paragraph.text, Chapter.date,
+                               Chapter.serial, Chapter.headline)
+                        .join(Chapter, Paragraph.chapter_id == Chapter.id)
+                        .filter(Paragraph.id.in_(ids)))
+        for (id, text, date, serial, headline) in query:
+            out[id] = {
+                'title': headline,
+                'url': flask.url_for('pages.steno_chapter',
+                                     date_str=date.isoformat(),
+                                     chapter_serial_number=
+                                        serial.split('/', 1)[1]),
+                'text': text,
+            }
+
+    for parent, model, endpoint, id_arg in [
+            ('question', models.Question,
+             'questions.question_detail', 'question_id'),
+            ('proposal', models.Proposal,
+             'proposals.proposal', 'proposal_id')]:
+        ids = ids_by_parent.get(parent)
+        if ids:
+            OcrText = models.OcrText
+            query = (session.query(model.id, model.title, OcrText.text)
+                            .join(OcrText, OcrText.id == model.id)
+                            .filter(model.id.in_(ids)))
+            for (id, title, text) in query:
+                out[id] = {
+                    'title': title,
+                    'url': flask.url_for(endpoint, **{id_arg: id}),
+                    'text': text,
+                }
+
+    ids = ids_by_parent.get('committee_summary')
+    if ids:
+        Summary = models.CommitteeSummary
+        query = (session.query(Summary.id, Summary.title, Summary.text)
+                        .filter(Summary.id.in_(ids)))
+        for (id, title, text) in query:
+            out[id] = {
+                'title': title,
+                'url': flask.url_for('pages.committee_summary',
+                                     summary_id=id),
+                'text': text,
+            }
+
+    return out
+
+
+def run_search(text, offset=0, limit=PAGE_SIZE):
+    """ Return one page of results, ranked, and whether there's a next page """
+    Document = models.SearchDocument
+    tsquery = func.plainto_tsquery(SEARCH_CONFIG, normalize(text))
+    rank = func.ts_rank(Document.vector, tsquery)
+    rows = (models.db.session.query(Document.id, Document.parent, rank)
+                .filter(Document.vector.op('@@')(tsquery))
+                .order_by(rank.desc(), Document.id)
+                .offset(offset)
+                .limit(limit + 1)
+                .all())
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    ids_by_parent = {}
+    for (id, parent, _) in rows:
+        ids_by_parent.setdefault(parent, []).append(id)
+    details = describe_results(ids_by_parent)
+
+    words = normalize(text).split()
+    results = []
+    for (id, parent, score) in rows:
+        if id not in details:
+            continue  # deleted since it was indexed
+        result = dict(details[id], id=id, parent=parent, score=score)
+        result['snippet'] = snippet(result.pop('text') or '', words)
+        results.append(result)
+    return results, has_next
+
+
+@search.route('/search')
+def search_page():
+    q = flask.request.args.get('q', '').strip()
+    page = max(1, flask.request.args.get('page', 1, type=int))
+    results = []
+    has_next = False
+    if q:
+        results, has_next = run_search(q, offset=(page - 1) * PAGE_SIZE)
+    return flask.render_template('search.html', **{
+        'q': q,
+        'page': page,
+        'page_size': PAGE_SIZE,
+        'results': results,
+        'has_next': has_next,
+    })
@@ -0,0 +1,85 @@
+import uuid
+
+
+def test_chunks_are_stored_once(tmpdir):
+    from mptracker.models import ChunkStore
+    store = ChunkStore(tmpdir)
+    digest, is_new = store.put('{"id": 1}\n')
+    assert is_new
+    assert store.put('{"id": 1}\n') == (digest, False)
+    assert store.get(digest) == '{"id": 1}\n'
+
+
+def test_new_row_changes_only_its_chunk():
+    from mptracker.models import chunk_boundary
+
+    def chunk(ids):
+        chunks = [[]]
+        for row_id in sorted(ids):
+            chunks[-1].append(row_id)
+            if chunk_boundary(row_id, chunk_rows=10):
+                chunks.append([])
+        return [tuple(c) for c in chunks if c]
+
+    ids = [str(uuid.uuid4()) for n in range(200)]
+    new_id = str(uuid.uuid4())
+    while chunk_boundary(new_id, chunk_rows=10):
+        new_id = str(uuid.uuid4())
+    before = chunk(ids)
+    after = chunk(ids + [new_id])
+    assert len(set(after) - set(before)) == 1
+
+
+def test_manifests_are_listed_in_order(tmpdir):
+    from mptracker.models import ChunkStore
+    store = ChunkStore(tmpdir)
+    store.save_manifest('2013-10-02-000000', {'tables': {}})
+    store.save_manifest('2013-10-01-000000', {'tables': {}})
+    assert store.manifest_names() == ['2013-10-01-000000',
+                                      '2013-10-02-000000']
+    assert store.load_manifest('2013-10-01-000000') == {'tables': {}}
+
+
+def test_restore_without_backups_names_the_store(tmpdir, monkeypatch):
+    import pytest
+    from mptracker.models import restore_backup
+    monkeypatch.setenv('BACKUP_DIR', str(tmpdir))
+    with pytest.raises(RuntimeError) as error:
+        restore_backup(folder_path=str(tmpdir))
+    assert str(tmpdir / 'incremental') in str(error.value)
+
+
+def test_tables_load_after_the_tables_they_refer_to():
+    from mptracker.models import table_load_levels
+    levels = table_load_levels({'person', 'mandate', 'sponsorship'})
+    assert levels == [['person'], ['mandate'], ['sponsorship']]
+
+
+def test_derived_tables_are_not_dumped():
+    from mptracker.models import dump_table_names
+    names = dump_table_names(xclude='')
+    assert 'mandate' in names
+    assert 'mandate_stats' not in names
+    assert 'search_document' not in names
+
+
+def test_derived_tables_are_rebuilt_after_load(pg_app, tmpdir):
+    from mptracker import models
+    session = models.db.session
+    chamber = models.Chamber(slug='cdep', name="Camera Deputaților")
+    person = models.Person(name="Ion Popescu")
+    mandate = models.Mandate(person=person, chamber=chamber, year=2012)
+    session.add(models.StenoParagraph(mandate=mandate, text="Brașov"))
+    session.commit()
+    mandate_id = mandate.id
+    models.refresh_mandate_stats()
+    session.commit()
+    models.dump_tables(str(tmpdir), xclude='', workers='2')
+
+    session.remove()
+    models.db.drop_all()
+    models.db.create_all()
+    models.load_tables(str(tmpdir), xclude='', workers='2')
+
+    assert models.MandateStats.query.get(mandate_id).paragraph_count == 1
+    assert models.SearchDocument.query.count() == 1
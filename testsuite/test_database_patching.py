@@ -1,15 +1,24 @@
+import os
 import pytest
 import flask
+from sqlalchemy import event
 from flask.ext.sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
 
+class Shelf(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+
+
 class Thing(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String)
     number = db.Column(db.Integer)
     name = db.Column(db.String)
+    shelf_id = db.Column(db.Integer, db.ForeignKey('shelf.id'))
+    shelf = db.relationship('Shelf')
 
 
 @pytest.fixture
@@ -23,6 +32,27 @@ def db_app(request):
     return app
 
 
+@pytest.fixture
+def pg_db_app(request):
+    database = os.environ.get('MPTRACKER_TEST_DATABASE')
+    if not database:
+        pytest.skip("MPTRACKER_TEST_DATABASE is not set")
+    app = flask.Flask('__main__')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    db.init_app(app)
+    ctx = app.app_context()
+    ctx.push()
+    db.create_all()
+
+    def teardown():
+        db.session.remove()
+        db.drop_all()
+        ctx.pop()
+
+    request.addfinalizer(teardown)
+    return app
+
+
 @pytest.fixture
 def patcher(db_app):
     from mptracker.common import TablePatcher
@@ -84,3 +114,173 @@ def test_patcher_add_returns_row(patcher):
     row1 = patcher.add({'code': 'an', 'name': "Anne"}).row
     row2 = patcher.add({'code': 'an', 'name': "Annette"}).row
     assert row1 == row2
+
+
+def test_unchanged_records_are_not_loaded(db_app):
+    from mptracker.common import TablePatcher
+    records = [{'code': 'an', 'name': "Anne"},
+               {'code': 'bo', 'name': "Bob"}]
+    TablePatcher(Thing, db.session, key_columns=['code']).update(records)
+    records[1]['name'] = "Bobby"
+    patcher = TablePatcher(Thing, db.session, key_columns=['code'])
+    counters = patcher.update(records)
+    assert (counters['n_ok'], counters['n_update']) == (1, 1)
+    assert list(patcher.rows) == [('bo',)]
+    assert sorted([t.name for t in Thing.query]) == ["Anne", "Bobby"]
+
+
+def test_equal_values_with_another_repr_are_not_updates(db_app):
+    from mptracker.common import TablePatcher
+    TablePatcher(Thing, db.session, key_columns=['code']).update(
+        [{'code': 'an', 'number': 1}])
+    patcher = TablePatcher(Thing, db.session, key_columns=['code'])
+    with patcher.process() as add:
+        result = add({'code': 'an', 'number': 1.0})
+        assert not result.is_changed
+    assert (patcher.counters['n_ok'], patcher.counters['n_update']) == (1, 0)
+
+
+def test_commit_every_keeps_progress(patcher):
+    with pytest.raises(RuntimeError):
+        with patcher.process(commit_every=2) as add:
+            add({'code': 'an', 'name': "Anne"})
+            add({'code': 'bo', 'name': "Bob"})
+            add({'code': 'cy', 'name': "Cyrus"})
+            raise RuntimeError("interrupted")
+    db.session.rollback()
+    assert sorted([t.code for t in Thing.query]) == ['an', 'bo']
+
+
+def count_statements(func):
+    statements = []
+
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, *args):
+        if statements is not None:
+            statements.append(statement)
+
+    func()
+    count = len(statements)
+    statements = None  # listeners can't be removed in SQLAlchemy 0.8
+    return count
+
+
+def test_relationship_values_are_compared_from_the_index(db_app):
+    from mptracker.common import TablePatcher
+
+    def patch(n_things, changed_code):
+        db.session.remove()
+        shelves = {shelf.name: shelf for shelf in Shelf.query}
+        records = [{'code': 'c%d' % n, 'name': "Thing %d" % n,
+                    'shelf': shelves['top' if n % 2 else 'bottom']}
+                   for n in range(n_things)]
+        for record in records:
+            if record['code'] == changed_code:
+                record['shelf'] = shelves['middle']
+        patcher = TablePatcher(Thing, db.session, key_columns=['code'])
+        return count_statements(lambda: patcher.update(records))
+
+    db.session.add_all([Shelf(name=name)
+                        for name in ['top', 'middle', 'bottom']])
+    db.session.commit()
+    patch(40, changed_code=None)
+    n_few = patch(10, changed_code='c1')
+    n_many = patch(40, changed_code='c3')
+    assert n_few == n_many == 3  # the index, the changed row, the update
+    assert Thing.query.filter_by(code='c3').one().shelf.name == 'middle'
+
+
+def test_records_with_other_fields_get_their_own_index(db_app):
+    from mptracker.common import TablePatcher
+    records = [{'code': 'c%d' % n, 'name': "Thing %d" % n, 'number': n}
+               for n in range(20)]
+    TablePatcher(Thing, db.session, key_columns=['code']).update(records)
+    db.session.remove()
+    records = [{'code': 'c%d' % n, 'name': "Thing %d" % n}
+               if n % 2 else {'code': 'c%d' % n, 'number': n}
+               for n in range(20)]
+    patcher = TablePatcher(Thing, db.session, key_columns=['code'])
+    assert count_statements(lambda: patcher.update(records)) == 2
+    assert patcher.counters['n_ok'] == 20
+
+
+def test_before_commit_is_committed_with_each_batch(patcher):
+    def before_commit():
+        db.session.add(Shelf(name="%d things" % Thing.query.count()))
+
+    with pytest.raises(RuntimeError):
+        with patcher.process(commit_every=2,
+                             before_commit=before_commit) as add:
+            add({'code': 'an', 'name': "Anne"})
+            add({'code': 'bo', 'name': "Bob"})
+            add({'code': 'cy', 'name': "Cyrus"})
+            raise RuntimeError("interrupted")
+    db.session.rollback()
+    assert [s.name for s in Shelf.query] == ["2 things"]
+
+
+def test_copy_text_value_escapes_special_characters():
+    from mptracker.common import copy_text_value
+    assert copy_text_value(None) == '\\N'
+    assert copy_text_value('') == ''
+    assert copy_text_value('a\tb\nc\\d') == 'a\\tb\\nc\\\\d'
+    assert copy_text_value(13) == '13'
+
+
+def test_bulk_patcher_copies_into_empty_table(pg_db_app):
+    from mptracker.common import BulkTablePatcher
+    patcher = BulkTablePatcher(Thing, db.session, key_columns=['code'])
+    counters = patcher.update([{'code': 'an', 'name': "Anne"},
+                               {'code': 'bo', 'name': "Bo\tb"}])
+    assert (counters['n_add'], counters['total']) == (2, 2)
+    assert sorted((t.code, t.name) for t in Thing.query) == \
+        [('an', "Anne"), ('bo', "Bo\tb")]
+
+
+def test_bulk_patcher_merges_staged_records(pg_db_app):
+    from mptracker.common import BulkTablePatcher
+    patcher = BulkTablePatcher(Thing, db.session, key_columns=['code'])
+    patcher.update([{'code': 'an', 'name': "Anne"},
+                    {'code': 'bo', 'name': "Bob"},
+                    {'code': 'cy', 'name': "Cyrus"}])
+
+    def row_versions():
+        rows = db.session.execute('SELECT code, xmin::text FROM thing')
+        return {code: xmin for (code, xmin) in rows}
+
+    versions = row_versions()
+    counters = patcher.update([{'code': 'an', 'name': "Anne"},
+                               {'code': 'bo', 'name': "Bobby"},
+                               {'code': 'di', 'name': "Diane"}],
+                              remove=True)
+    assert counters == {'n_add': 1, 'n_update': 1, 'n_remove': 1,
+                        'n_ok': 1, 'total': 3}
+    assert sorted((t.code, t.name) for t in Thing.query) == \
+        [('an', "Anne"), ('bo', "Bobby"), ('di', "Diane")]
+    assert row_versions()['an'] == versions['an']
+
+
+def test_bulk_patcher_refuses_to_create_records(pg_db_app):
+    from mptracker.common import BulkTablePatcher, RowNotFound
+    patcher = BulkTablePatcher(Thing, db.session, key_columns=['code'])
+    patcher.update([{'code': 'an', 'name': "Anne"}])
+    with pytest.raises(RowNotFound):
+        patcher.update([{'code': 'bo', 'name': "Bob"}], create=False)
+    assert [t.code for t in Thing.query] == ['an']
+
+
+def test_bulk_patcher_rejects_null_and_duplicate_keys(pg_db_app):
+    from mptracker.common import BulkTablePatcher, NullKey, DuplicateKey
+    patcher = BulkTablePatcher(Thing, db.session, key_columns=['code'])
+    patcher.update([{'code': 'an', 'name': "Anne"}])
+    with pytest.raises(NullKey):
+        patcher.update([{'code': 'bo', 'name': "Bob"},
+                        {'code': None, 'name': "Nobody"}])
+    with pytest.raises(DuplicateKey):
+        patcher.update([{'code': 'bo', 'name': "Bob"},
+                        {'code': 'bo', 'name': "Bobby"}])
+    twin_key_patcher = BulkTablePatcher(Thing, db.session,
+                                        key_columns=['code', 'number'])
+    with pytest.raises(NullKey):
+        twin_key_patcher.update([{'code': 'bo', 'number': None}])
+    assert [t.code for t in Thing.query] == ['an']
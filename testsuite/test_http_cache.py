@@ -0,0 +1,74 @@
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pytest
+
+
+class RevalidatingHandler(BaseHTTPRequestHandler):
+    """ Serves pages with an ETag and answers conditional requests """
+
+    requests = []
+
+    def do_GET(self):
+        etag = '"v1"'
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = ('page %s' % self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url(request):
+    RevalidatingHandler.requests = []
+    server = HTTPServer(('127.0.0.1', 0), RevalidatingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return 'http://127.0.0.1:%d' % server.server_port
+
+
+@pytest.fixture
+def cache(tmpdir):
+    from mptracker.scraper.httpcache import HttpCache
+    return HttpCache(tmpdir / 'test.cache.sqlite')
+
+
+def test_detail_pages_are_served_from_cache(server_url, cache):
+    from mptracker.scraper.httpcache import CachedSession
+    session = CachedSession(cache, policies=[])
+    first = session.get(server_url + '/detail')
+    second = session.get(server_url + '/detail')
+    assert not first.from_cache
+    assert second.from_cache
+    assert second.content == b'page /detail'
+    assert RevalidatingHandler.requests == [('/detail', None)]
+
+
+def test_expired_pages_are_revalidated(server_url, cache):
+    from mptracker.scraper.httpcache import CachedSession
+    session = CachedSession(cache, policies=[('/listing', -1)])
+    session.get(server_url + '/listing')
+    page = session.get(server_url + '/listing')
+    assert page.content == b'page /listing'
+    assert RevalidatingHandler.requests == [('/listing', None),
+                                            ('/listing', '"v1"')]
+
+
+def test_compact_drops_stale_responses(server_url, cache):
+    from mptracker.scraper.httpcache import CachedSession
+    session = CachedSession(cache, policies=[('/listing', -1)])
+    session.get(server_url + '/listing')
+    session.get(server_url + '/detail')
+    assert cache.stats()['stale'] == 1
+    assert cache.compact(stale_for=0) == 1
+    assert cache.stats()['responses'] == 1
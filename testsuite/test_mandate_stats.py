@@ -0,0 +1,37 @@
+def create_mandate():
+    from mptracker import models
+    chamber = models.Chamber(slug='cdep', name="Camera Deputaților")
+    person = models.Person(name="Ion Popescu")
+    mandate = models.Mandate(person=person, chamber=chamber, year=2012)
+    models.db.session.add(mandate)
+    models.db.session.commit()
+    return mandate
+
+
+def test_stats_count_rows_that_are_not_flushed_yet(sqlite_app):
+    from mptracker import models
+    mandate = create_mandate()
+    session = models.db.session
+    session.add_all([
+        models.Question(mandate=mandate, type='question'),
+        models.Question(mandate=mandate, type='interpelation'),
+        models.StenoParagraph(mandate=mandate, text="Text"),
+    ])
+    models.refresh_mandate_stats([mandate.id])
+    session.commit()
+    stats = models.MandateStats.query.get(mandate.id)
+    assert (stats.question_count, stats.interpelation_count,
+            stats.paragraph_count, stats.sponsorship_count) == (1, 1, 1, 0)
+
+
+def test_refresh_replaces_stats(sqlite_app):
+    from mptracker import models
+    mandate = create_mandate()
+    session = models.db.session
+    question = models.Question(mandate=mandate, type='question')
+    session.add(question)
+    models.refresh_mandate_stats()
+    session.delete(question)
+    models.refresh_mandate_stats([mandate.id])
+    session.commit()
+    assert models.MandateStats.query.get(mandate.id).question_count == 0
@@ -1,4 +1,5 @@
-from mptracker.nlp import match_names
+import flask
+from mptracker.nlp import match_names, NameMatcher
 
 
 def test_match_string_in_text():
@@ -60,3 +61,40 @@ def test_match_stemmed_name():
     text = "azi argeșenele se revoltă"
     match = match_names(text, ['Argeș'])
     assert [m['name'] for m in match] == ['Argeș']
+
+
+def test_prefer_longest_name():
+    text = "azi la cluj-napoca si la cluj"
+    match = match_names(text, ["Cluj", "Cluj-Napoca"])
+    assert [m['name'] for m in match] == ["Cluj-Napoca", "Cluj"]
+    assert match[0]['token'].text == "cluj napoca"
+
+
+def test_reuse_matcher_for_many_texts():
+    matcher = NameMatcher(["brasov", "câmpina"])
+    assert [m['name'] for m in matcher.match("foo brașov")] == ['brasov']
+    assert [m['name'] for m in matcher.match("câmpina bar")] == ['câmpina']
+    assert matcher.match("nothing here") == []
+
+
+def test_county_matcher_reloaded_when_data_file_changes(tmpdir):
+    from mptracker.nlp import get_county_matcher
+    app = flask.Flask('__main__')
+    app.root_path = str(tmpdir)
+    json_path = tmpdir.mkdir('placename_data').join('99.json')
+
+    def save(place_names):
+        county = {'code': 99, 'name': "Prahova", 'place_names': place_names}
+        json_path.write(flask.json.dumps(county))
+
+    with app.app_context():
+        save(["Sinaia"])
+        matcher = get_county_matcher(99)
+        assert get_county_matcher(99) is matcher
+        assert [m['name'] for m in matcher.match("la câmpina")] == []
+
+        save(["Sinaia", "Câmpina"])
+        new_matcher = get_county_matcher(99)
+        assert new_matcher is not matcher
+        assert [m['name'] for m in new_matcher.match("la câmpina")] == \
+               ["Câmpina"]
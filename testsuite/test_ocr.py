@@ -0,0 +1,48 @@
+def test_split_text_layer_into_pages(monkeypatch):
+    from mptracker import common
+    monkeypatch.setattr(common, 'pdf_to_text',
+                        lambda pdf_bytes, last_page: "one\fpage two\f\f")
+    assert common.pdf_text_pages(b'', 5) == ["one", "page two", ""]
+    assert common.pdf_text_pages(b'', 2) == ["one", "page two"]
+
+
+def test_scanned_page_has_no_text_layer():
+    from mptracker.common import has_text_layer
+    assert not has_text_layer("  \n \x0c ")
+    assert has_text_layer("Expunere de motive privind modificarea legii")
+
+
+def test_pdftotext_is_killed_on_timeout(monkeypatch):
+    import subprocess
+    import pytest
+    from mptracker import common
+    popen = subprocess.Popen
+    started = []
+
+    def slow_popen(args, **kwargs):
+        p = popen(['sleep', '30'], **kwargs)
+        started.append(p)
+        return p
+
+    monkeypatch.setattr(common.subprocess, 'Popen', slow_popen)
+    monkeypatch.setattr(common, 'PDFTOTEXT_TIMEOUT', 0.1)
+    with pytest.raises(subprocess.TimeoutExpired):
+        common.pdf_to_text(b'')
+    [p] = started
+    assert p.returncode is not None
+
+
+def test_proposals_with_empty_text_are_ocred_again(sqlite_app, monkeypatch):
+    from mock import Mock
+    from mptracker import models, proposals
+    ocr_proposal = Mock()
+    monkeypatch.setattr(proposals, 'ocr_proposal', ocr_proposal)
+    for title, text in [("Done", "Text"), ("Failed", None)]:
+        proposal = models.Proposal(title=title, pdf_url='http://pdf/' + title)
+        proposal.text = text
+        models.db.session.add(proposal)
+    models.db.session.commit()
+    proposals.ocr_all()
+    failed = models.Proposal.query.filter_by(title="Failed").one()
+    [call] = ocr_proposal.delay.mock_calls
+    assert call[1][0] == failed.id
@@ -0,0 +1,48 @@
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+
+@pytest.fixture
+def session():
+    engine = sa.create_engine('sqlite://')
+    metadata = sa.MetaData()
+    table = sa.Table('item', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('score', sa.Integer))
+    metadata.create_all(engine)
+    engine.execute(table.insert(), [{'id': n, 'score': n % 4}
+                                    for n in range(1, 24)])
+    session = sessionmaker(bind=engine)()
+    session.item = table
+    return session
+
+
+def test_keyset_pages_cover_every_row_once(session):
+    from mptracker.common import keyset_page
+    table = session.item
+    sort_keys = [(table.c.score, True), (table.c.id, False)]
+    query = session.query(table.c.id, table.c.score)
+    expected = query.order_by(table.c.score.desc(), table.c.id).all()
+
+    rows = []
+    cursor = None
+    while True:
+        page, cursor = keyset_page(query, sort_keys,
+                                   lambda row: [row.score, row.id],
+                                   cursor=cursor, limit=5)
+        assert len(page) <= 5
+        rows.extend(page)
+        if cursor is None:
+            break
+    assert rows == expected
+
+
+def test_bad_cursor_is_rejected(session):
+    from mptracker.common import keyset_page, encode_cursor, InvalidCursor
+    table = session.item
+    query = session.query(table.c.id)
+    sort_keys = [(table.c.id, False)]
+    for cursor in ['not a cursor', encode_cursor([1, 2])]:
+        with pytest.raises(InvalidCursor):
+            keyset_page(query, sort_keys, list, cursor=cursor)
@@ -0,0 +1,59 @@
+from sqlalchemy import event
+
+
+def create_person(n_mandates):
+    from mptracker import models
+    session = models.db.session
+    chamber = models.Chamber(slug='cdep', name="Camera Deputaților")
+    county = models.County(name="Brașov")
+    group = models.MpGroup(name="Grupul", short_name="G")
+    committee = models.MpCommittee(name="Comisia")
+    person = models.Person(name="Ion Popescu")
+    for n in range(n_mandates):
+        mandate = models.Mandate(person=person, chamber=chamber,
+                                 county=county, year=2004 + 4 * n,
+                                 cdep_number=n + 1)
+        session.add(models.Question(mandate=mandate, title="Întrebare"))
+        session.add(models.StenoParagraph(mandate=mandate, text="Text"))
+        session.add(models.Sponsorship(mandate=mandate,
+                                       proposal=models.Proposal()))
+        session.add(models.MpGroupMembership(mandate=mandate,
+                                             mp_group=group))
+        session.add(models.MpCommitteeMembership(mandate=mandate,
+                                                 mp_committee=committee))
+    session.add(person)
+    session.commit()
+    return person.id
+
+
+def count_statements(app, url):
+    from mptracker import models
+    statements = []
+
+    @event.listens_for(models.db.engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, *args):
+        if statements is not None:
+            statements.append(statement)
+
+    resp = app.test_client().get(url)
+    assert resp.status_code == 200
+    count = len(statements)
+    statements = None  # listeners can't be removed in SQLAlchemy 0.8
+    return count
+
+
+def check_person_page_queries(app):
+    one = create_person(n_mandates=1)
+    three = create_person(n_mandates=3)
+    n_one = count_statements(app, '/person/%s' % one)
+    n_three = count_statements(app, '/person/%s' % three)
+    assert n_one == n_three
+    assert n_three <= 4
+
+
+def test_person_page_queries_dont_grow_with_mandates(sqlite_app):
+    check_person_page_queries(sqlite_app)
+
+
+def test_person_page_queries_dont_grow_on_postgresql(pg_app):
+    check_person_page_queries(pg_app)
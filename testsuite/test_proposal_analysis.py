@@ -0,0 +1,41 @@
+import flask
+
+
+def create_sponsorship(proposal_text, minority=False, county=None):
+    from mptracker import models
+    chamber = models.Chamber(slug='cdep', name="Camera Deputaților")
+    person = models.Person(name="Ion Popescu")
+    mandate = models.Mandate(person=person, chamber=chamber, county=county,
+                             minority=minority, year=2012)
+    proposal = models.Proposal(title="Propunere")
+    proposal.text = proposal_text
+    sponsorship = models.Sponsorship(mandate=mandate, proposal=proposal)
+    models.db.session.add(sponsorship)
+    models.db.session.commit()
+    return sponsorship.id
+
+
+def test_skipped_sponsorships_get_no_match_row(sqlite_app):
+    from mptracker import models
+    from mptracker.proposals import analyze_all
+    create_sponsorship(proposal_text=None, minority=True)
+    create_sponsorship(proposal_text="Text", county=None)
+    create_sponsorship(proposal_text="Text",
+                       county=models.County(name="Brașov"))
+    analyze_all(local=True, workers='1')
+    models.db.session.commit()
+    assert models.Match.query.count() == 0
+
+
+def test_local_analysis_saves_sponsorship_matches(sqlite_app):
+    from mptracker import models
+    from mptracker.proposals import analyze_all
+    sponsorship_id = create_sponsorship(
+        proposal_text="Despre școlile comunității albaneze", minority=True)
+    analyze_all(local=True, workers='1')
+    models.db.session.remove()
+    match = models.Match.query.get(sponsorship_id)
+    assert match.parent == 'sponsorship'
+    data = flask.json.loads(match.data)
+    assert [m['name'] for m in data['top_matches']] == ['albaneze']
+    assert match.score == 1
@@ -0,0 +1,50 @@
+import flask
+
+
+def create_question(text):
+    from mptracker import models
+    chamber = models.Chamber(slug='cdep', name="Camera Deputaților")
+    person = models.Person(name="Ion Popescu")
+    mandate = models.Mandate(person=person, chamber=chamber,
+                             minority=True, year=2012)
+    question = models.Question(mandate=mandate, type='question',
+                               title="Întrebare")
+    question.text = text
+    models.db.session.add(question)
+    models.db.session.commit()
+    return question.id, mandate.id
+
+
+def test_local_analysis_saves_matches_and_stats(sqlite_app):
+    from mptracker import models
+    from mptracker.questions import analyze_all
+    question_id, mandate_id = create_question(
+        "Despre școlile comunității albaneze din București")
+    analyze_all(local=True, workers='1')
+    models.db.session.remove()
+
+    match = models.Match.query.get(question_id)
+    data = flask.json.loads(match.data)
+    assert [m['name'] for m in data['top_matches']] == ['albaneze']
+    assert match.score == 1
+    stats = models.MandateStats.query.get(mandate_id)
+    assert (stats.local_question_count, stats.local_score) == (1, 1)
+
+
+def test_forced_local_analysis_updates_match_rows(sqlite_app):
+    from mptracker import models
+    from mptracker.questions import analyze_all
+    question_id, mandate_id = create_question("Nimic de găsit")
+    analyze_all(local=True, workers='1')
+    models.db.session.remove()
+    assert models.Match.query.get(question_id).score == 0
+
+    question = models.Question.query.get(question_id)
+    question.text = "Comunitatea albaneză"
+    models.db.session.commit()
+    analyze_all(local=True, force=True, workers='1')
+    models.db.session.remove()
+    assert models.Match.query.count() == 1
+    assert models.Match.query.get(question_id).score == 1
+    stats = models.MandateStats.query.get(mandate_id)
+    assert (stats.local_question_count, stats.local_score) == (1, 1)
@@ -0,0 +1,44 @@
+def create_proposals():
+    from mptracker import models
+    chamber = models.Chamber(slug='cdep', name="Camera Deputaților")
+    mandates = [models.Mandate(person=models.Person(name=name),
+                               chamber=chamber, year=2012, cdep_number=n)
+                for (n, name) in [(1, "Ion Popescu"), (2, "Ion Ionescu")]]
+    models.db.session.add_all(mandates)
+    for combined_id in ['cdep=1 senate=', 'cdep=2 senate=']:
+        proposal = models.Proposal(combined_id=combined_id, title="Old")
+        models.db.session.add(models.Sponsorship(mandate=mandates[0],
+                                                 proposal=proposal))
+    models.db.session.commit()
+
+
+def table_contents():
+    from mptracker import models
+    session = models.db.session
+    return (
+        sorted(session.query(models.Proposal.combined_id,
+                             models.Proposal.title)),
+        sorted(session.query(models.Sponsorship.proposal_id,
+                             models.Sponsorship.mandate_id)),
+    )
+
+
+def test_proposals_dry_run_changes_nothing(sqlite_app, monkeypatch):
+    from mptracker import scraper
+    from mptracker.scraper.proposals import ProposalScraper
+
+    def fetch_from_mp_pages(self, mandate_cdep_id_list):
+        yield {'combined_id': 'cdep=1 senate=', 'title': "New",
+               '_sponsorships': [(2012, 2)]}
+        yield {'combined_id': 'cdep=3 senate=', 'title': "Added",
+               '_sponsorships': [(2012, 1)]}
+
+    monkeypatch.setattr(scraper, 'create_session', lambda **kwargs: None)
+    monkeypatch.setattr(ProposalScraper, 'fetch_from_mp_pages',
+                        fetch_from_mp_pages)
+    create_proposals()
+    before = table_contents()
+    # the `proposals` submodule shadows the command on the package
+    command = scraper.scraper_manager._commands['proposals']
+    command.run(dry_run=True)
+    assert table_contents() == before
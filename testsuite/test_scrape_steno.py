@@ -63,3 +63,76 @@ def test_2013_06_10(session):
 
     assert paragraphs[-2]['speaker_cdep_id'] is None
     assert paragraphs[-2]['speaker_name'] == "Georgeta Bratu"
+
+
+def test_skip_chapters_already_imported(session):
+    STENO_URL = 'http://www.cdep.ro/pls/steno/'
+    session.url_map.update({
+        STENO_URL + 'steno.data?cam=2&idl=1&dat=20130610':
+            PAGES_DIR / 'steno.data-20130610',
+        STENO_URL + 'steno.stenograma?ids=7277&idm=12&idl=1':
+            PAGES_DIR / 'steno.stenograma-7277-12',
+    })
+    steno_scraper = steno.StenogramScraper(session)
+    skip_serials = set('2013-06-10/%02d' % n for n in range(1, 12))
+    steno_day = steno_scraper.fetch_day(date(2013, 6, 10), skip_serials)
+
+    assert [c.serial for c in steno_day.chapters] == ['2013-06-10/12']
+    paragraph = steno_day.chapters[0].paragraphs[0]
+    assert paragraph['serial'] == '2013-06-10/12-001'
+
+
+def steno_day_url_map():
+    STENO_URL = 'http://www.cdep.ro/pls/steno/'
+    url_map = {
+        STENO_URL + 'steno.data?cam=2&idl=1&dat=20130610':
+            PAGES_DIR / 'steno.data-20130610',
+    }
+    for n in range(1, 13):
+        url = STENO_URL + 'steno.stenograma?ids=7277&idm=%d&idl=1' % n
+        url_map[url] = PAGES_DIR / ('steno.stenograma-7277-%d' % n)
+    return url_map
+
+
+def test_fetch_days_keeps_to_one_pool(session):
+    import threading
+    import time
+    session.url_map.update(steno_day_url_map())
+    in_flight = []
+    most_in_flight = [0]
+    lock = threading.Lock()
+    mock_get = session.get
+
+    def get(url):
+        with lock:
+            in_flight.append(url)
+            most_in_flight[0] = max(most_in_flight[0], len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(url)
+        return mock_get(url)
+
+    session.get = get
+    steno_scraper = steno.StenogramScraper(session, workers=3)
+    days = [date(2013, 6, 10), date(2013, 6, 11), date(2013, 6, 10)]
+    results = list(steno_scraper.fetch_days(days, lambda day: ()))
+
+    assert [day for (day, _, _) in results] == days
+    assert len(results[0][1].chapters) == 12
+    assert isinstance(results[1][2], KeyError)  # no page for that day
+    assert len(results[2][1].chapters) == 12
+    assert most_in_flight[0] <= 3
+
+
+def test_import_steno_imports_repeated_day_once(sqlite_app, session,
+                                                monkeypatch):
+    import io
+    import sys
+    from mptracker import models
+    from mptracker.app import import_steno
+    from mptracker.scraper import common
+    session.url_map.update(steno_day_url_map())
+    monkeypatch.setattr(common, 'create_session', lambda **kwargs: session)
+    monkeypatch.setattr(sys, 'stdin', io.StringIO("2013-06-10\n" * 2))
+    import_steno(stdin=True, workers='2')
+    assert models.StenoChapter.query.count() == 12
@@ -0,0 +1,113 @@
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import pytest
+import requests
+
+PAGE_DELAY = 0.2
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class CdepStandInHandler(BaseHTTPRequestHandler):
+    """ Serves slow, iso-8859-2 encoded pages, like cdep.ro does """
+
+    arrivals = []
+
+    def do_GET(self):
+        self.arrivals.append(time.monotonic())
+        time.sleep(PAGE_DELAY)
+        html = '<html><body><p id="path">%s ţară</p></body></html>' % self.path
+        body = html.encode('iso-8859-2')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_url(request):
+    CdepStandInHandler.arrivals = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CdepStandInHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    request.addfinalizer(server.shutdown)
+    return 'http://127.0.0.1:%d' % server.server_port
+
+
+def test_fetch_pages_concurrently(server_url):
+    from mptracker.scraper.common import Scraper
+    scraper = Scraper(requests.Session(), workers=8)
+    urls = [server_url + '/page/%d' % n for n in range(8)]
+    t0 = time.time()
+    pages = list(scraper.map(scraper.fetch_url, urls))
+    assert time.time() - t0 < PAGE_DELAY * 4
+    assert [p('#path').text() for p in pages] == \
+           ['/page/%d ţară' % n for n in range(8)]
+
+
+def test_throttle_is_shared_between_threads(server_url):
+    from mptracker.scraper.common import Scraper, create_session
+    throttle = 0.2
+    scraper = Scraper(create_session(throttle=throttle), workers=8)
+    urls = [server_url + '/page/%d' % n for n in range(6)]
+    list(scraper.map(scraper.fetch_url, urls))
+    arrivals = sorted(CdepStandInHandler.arrivals)
+    assert len(arrivals) == 6
+    gaps = [b - a for (a, b) in zip(arrivals, arrivals[1:])]
+    # requests leave the client `throttle` apart; allow for the time it
+    # takes the server to pick each one up
+    assert min(gaps) >= throttle - 0.05
+
+
+def test_proposal_details_are_fetched_once():
+    from mptracker.scraper.proposals import ProposalScraper
+
+    class StubProposalScraper(ProposalScraper):
+        details_fetched = []
+
+        def fetch_mp_proposals(self, cdep_id):
+            yield 'cdep=1 senate=', 'http://cdep/proposal/1'
+            if cdep_id == (2012, 2):
+                yield 'cdep=2 senate=', 'http://cdep/proposal/2'
+
+        def fetch_proposal_details(self, url):
+            self.details_fetched.append(url)
+            return {'url': url}
+
+    scraper = StubProposalScraper(requests.Session(), workers=4)
+    records = list(scraper.fetch_from_mp_pages([(2012, 1), (2012, 2)]))
+    assert sorted(scraper.details_fetched) == ['http://cdep/proposal/1',
+                                               'http://cdep/proposal/2']
+    sponsors = {r['combined_id']: r['_sponsorships'] for r in records}
+    assert sponsors == {'cdep=1 senate=': [(2012, 1), (2012, 2)],
+                        'cdep=2 senate=': [(2012, 2)]}
+
+
+def test_links_are_made_absolute_from_many_threads():
+    from mock import Mock
+    from mptracker.scraper.common import Scraper
+
+    class LinkPageSession:
+
+        def get(self, url):
+            links = ''.join('<a href="link/%d">%d</a>' % (n, n)
+                            for n in range(200))
+            html = '<html><body>%s</body></html>' % links
+            return Mock(content=html.encode('iso-8859-2'))
+
+    scraper = Scraper(LinkPageSession(), workers=8)
+    urls = ['http://cdep/page/%d/' % n for n in range(16)]
+    pages = list(scraper.map(scraper.fetch_url, urls))
+    for url, page in zip(urls, pages):
+        assert [a.attrib['href'] for a in page('a')] == \
+               [url + 'link/%d' % n for n in range(200)]
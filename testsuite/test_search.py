@@ -0,0 +1,125 @@
+def test_snippet_around_words_regardless_of_diacritics():
+    from mptracker.search import snippet
+    text = "foo " * 200 + "Județul Brașov" + " bar" * 200
+    fragment = snippet(text, ['brasov'])
+    assert fragment.startswith('…')
+    assert "Județul Brașov" in fragment
+
+
+def test_snippet_without_match_starts_at_beginning():
+    from mptracker.search import snippet
+    assert snippet("Domnul deputat", ['sinaia']) == "Domnul deputat"
+
+
+def search_documents():
+    from mptracker import models
+    return {doc.id: (doc.parent, doc.vector)
+            for doc in models.SearchDocument.query}
+
+
+def test_index_follows_paragraph_changes(sqlite_app):
+    from mptracker import models
+    session = models.db.session
+    paragraph = models.StenoParagraph(text="Județul Brașov")
+    session.add(paragraph)
+    session.commit()
+    assert search_documents() == {
+        paragraph.id: ('steno_paragraph', "judetul brasov")}
+
+    paragraph.text = "Orașul Sinaia"
+    session.commit()
+    assert search_documents() == {
+        paragraph.id: ('steno_paragraph', "orasul sinaia")}
+
+    session.delete(paragraph)
+    session.commit()
+    assert search_documents() == {}
+
+
+def test_index_takes_parent_and_columns_from_model(sqlite_app):
+    from mptracker import models
+    session = models.db.session
+    ocr_text = models.OcrText(id=models.random_uuid(), parent='question',
+                              text="Întrebare")
+    summary = models.CommitteeSummary(title="Ședința", text="Comisia")
+    blank = models.StenoParagraph(text="  ")
+    session.add_all([ocr_text, summary, blank])
+    session.commit()
+    assert search_documents() == {
+        ocr_text.id: ('question', "intrebare"),
+        summary.id: ('committee_summary', "sedinta\ncomisia"),
+    }
+
+
+def test_reindex_rebuilds_one_parent(sqlite_app):
+    from mptracker import models
+    from mptracker.search import reindex, index_documents
+    session = models.db.session
+    paragraphs = [models.StenoParagraph(text="Text %d" % n)
+                  for n in range(5)]
+    summary = models.CommitteeSummary(title="Ședința", text="Comisia")
+    session.add_all(paragraphs + [summary])
+    session.commit()
+    expected = search_documents()
+
+    session.execute(models.SearchDocument.__table__.delete())
+    assert index_documents(session, [(summary.id, 'committee_summary',
+                                      "Ședința\nComisia"),
+                                     (paragraphs[0].id, 'steno_paragraph',
+                                      "")]) == 1
+    reindex(parent='steno_paragraph', batch_size=2)
+    assert search_documents() == expected
+
+
+class StubQuery:
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def __getattr__(self, name):
+        def method(*args):
+            self.calls.append((name, args))
+            return self
+        return method
+
+    def all(self):
+        return self.rows
+
+
+def test_run_search_pages_results_and_drops_deleted_rows(monkeypatch):
+    from mptracker import search, models
+    rows = [('a', 'steno_paragraph', 0.9),
+            ('b', 'steno_paragraph', 0.5),
+            ('c', 'question', 0.1)]
+    query = StubQuery(rows)
+    session = type('StubSession', (), {'query': lambda self, *a: query})()
+    monkeypatch.setattr(models.db, 'session', session)
+    monkeypatch.setattr(search, 'describe_results', lambda ids_by_parent: {
+        'a': {'title': "A", 'url': '/a', 'text': "Domnul deputat"},
+    })
+
+    results, has_next = search.run_search("deputat", offset=4, limit=2)
+    assert has_next
+    assert ('offset', (4,)) in query.calls
+    assert ('limit', (3,)) in query.calls
+    assert results == [{'id': 'a', 'parent': 'steno_paragraph', 'score': 0.9,
+                        'title': "A", 'url': '/a',
+                        'snippet': "Domnul deputat"}]
+
+
+def test_run_search_ranks_matches_on_postgresql(pg_app):
+    from datetime import date
+    from mptracker import models
+    from mptracker.search import run_search
+    session = models.db.session
+    chapter = models.StenoChapter(date=date(2013, 6, 10),
+                                  serial='2013-06-10/01', headline="Ședința")
+    texts = ["Brașov, Brașov și iar Brașov", "Județul Brașov", "Sinaia"]
+    session.add_all([models.StenoParagraph(chapter=chapter, text=text)
+                     for text in texts])
+    session.commit()
+    with pg_app.test_request_context():
+        results, has_next = run_search("brasov")
+    assert not has_next
+    assert [r['snippet'] for r in results] == texts[:2]